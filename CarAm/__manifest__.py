@@ -25,15 +25,22 @@
     ],
     'data': [
         'security/ir.model.access.csv',
+        'data/ir_cron.xml',
         'views/res_partner_views.xml',
         'views/loyality_history_views.xml',
         'wizards/loyalty_history_wizard_views.xml',
+        'wizards/caram_wallet_balance_wizard_views.xml',
         'views/res_config_settings_views.xml',
         'views/sale_subscription_plan_views.xml',
         'views/account_journal_views.xml',
         'views/account_payment_views.xml',
         'views/product_template_views.xml',
         'views/caram_ride_views.xml',
+        'views/caram_wallet_checkpoint_views.xml',
+        'views/caram_commission_accrual_views.xml',
+        'views/caram_accounting_job_views.xml',
+        'views/caram_driver_earnings_views.xml',
+        'views/caram_status_outbox_views.xml',
         'views/caram_menus.xml',
     ],
     'installable': True,
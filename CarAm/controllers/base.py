@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import functools
+import json
+import logging
+import threading
+import time
+
+from odoo import http
+from odoo.exceptions import UserError
+from odoo.http import request
+from odoo.service.model import MAX_TRIES_ON_CONCURRENCY_FAILURE
+
+_logger = logging.getLogger(__name__)
+
+
+def _sql_counters():
+    """SQL query count and time of the current thread, as maintained by odoo.sql_db."""
+    thread = threading.current_thread()
+    return getattr(thread, "query_count", 0), getattr(thread, "query_time", 0.0)
+
+
+@contextmanager
+def caram_phase(name):
+    """Add the wall time of the block to phase `name` of the current instrumented request."""
+    timings = getattr(request, "_caram_timings", None) if request else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def instrumented(endpoint):
+    """Time an API endpoint: per-phase wall time (see `caram_phase`), SQL query count and time.
+
+    The figures are returned in a `Server-Timing` header and logged as one JSON line.
+    """
+
+    @functools.wraps(endpoint)
+    def wrapper(self, *args, **kwargs):
+        timings = request._caram_timings = {}
+        query_count, query_time = _sql_counters()
+        start = time.perf_counter()
+        response = None
+        try:
+            response = endpoint(self, *args, **kwargs)
+            return response
+        finally:
+            total = time.perf_counter() - start
+            count, sql_time = _sql_counters()
+            count -= query_count
+            sql_time -= query_time
+            if response is not None:
+                metrics = [f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items()]
+                metrics.append(f'db;dur={sql_time * 1000:.1f};desc="{count} queries"')
+                metrics.append(f"total;dur={total * 1000:.1f}")
+                response.headers["Server-Timing"] = ", ".join(metrics)
+            _logger.info("CarAm API %s", json.dumps({
+                "path": request.httprequest.path,
+                "status": response.status_code if response is not None else None,
+                "total_ms": round(total * 1000, 1),
+                "sql_count": count,
+                "sql_ms": round(sql_time * 1000, 1),
+                "phases_ms": {name: round(duration * 1000, 1) for name, duration in timings.items()},
+            }))
+
+    return wrapper
+
+
+class CaramApiController(http.Controller):
+    """Common base of the CarAm API controllers: token authentication and company environment."""
+
+    def _authenticate(self):
+        """Validate Bearer Token and return the user"""
+        with caram_phase("auth"):
+            auth = request.httprequest.headers.get("Authorization")
+            if not auth or not auth.startswith("Bearer "):
+                raise UserError("Missing or invalid Authorization header")
+
+            token = auth.split(" ")[1]
+            user_id = request.env["res.users.apikeys"]._caram_check_credentials(token)
+            if not user_id:
+                raise UserError("Invalid API token")
+
+            return request.env["res.users"].sudo().browse(int(user_id))
+
+    def _get_env(self, user):
+        """Get environment with company context"""
+        company = user.company_id
+        return request.env(
+            user=user,
+            context=dict(
+                request.env.context,
+                allowed_company_ids=[company.id],
+                company_id=company.id,
+            )
+        )
+
+    def _concurrency_failure(self, error):
+        """Handle a lock or serialization failure raised by a wallet operation.
+
+        A payment that waited for another one on the same wallet fails once that one commits
+        (see `loyalty.card._caram_lock`). The error is re-raised so Odoo's dispatcher replays
+        the request with a fresh snapshot; when its retries are exhausted the request is
+        answered with a 503 and a `Retry-After` header instead of an HTTP 500.
+        """
+        request._caram_concurrency_failures = getattr(request, "_caram_concurrency_failures", 0) + 1
+        if request._caram_concurrency_failures < MAX_TRIES_ON_CONCURRENCY_FAILURE:
+            raise error
+        request.env.cr.rollback()
+        _logger.warning("CarAm API %s: giving up after %s concurrency failures: %s",
+                        request.httprequest.path, request._caram_concurrency_failures, error)
+        return request.make_json_response(
+            {"error": "The wallet is busy with another operation, retry the request"},
+            headers=[("Retry-After", "1")],
+            status=503,
+        )
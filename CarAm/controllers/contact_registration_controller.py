@@ -4,115 +4,105 @@ from odoo import http
 from odoo import models, fields, api  # Add this line at the top
 from odoo.http import request
 from odoo.exceptions import UserError
+from psycopg2 import errors as pg_errors
+from datetime import timedelta
 import json
 
+from ..models.res_partner import normalize_email, normalize_mobile
+from .base import CaramApiController, caram_phase, instrumented
+from .idempotency import idempotent
 
-class ContactRegistrationController(http.Controller):
-    
-    def _get_env(self, user):
-      company = user.company_id
-      return request.env(
-        user=user,
-        context=dict(
-            request.env.context,
-            allowed_company_ids=[company.id],
-            company_id=company.id,
-        )
-    )
-
-    def _authenticate(self):
-        """Validate Bearer Token and return the user"""
-        auth = request.httprequest.headers.get("Authorization")
-
-        if not auth or not auth.startswith("Bearer "):
-            raise UserError("Missing or invalid Authorization header")
-
-        token = auth.split(" ")[1]
-        user_id = request.env["res.users.apikeys"]._check_credentials(
-            scope="api", key=token
-        )
-
-        if not user_id:
-            raise UserError("Invalid API token")
-
-        return request.env["res.users"].sudo().browse(int(user_id))
+# Lock waits and serialization failures are retried by Odoo's request dispatcher,
+# so they must reach it (see CaramApiController._concurrency_failure) instead of
+# being turned into HTTP 500 responses.
+CONCURRENCY_ERRORS = (pg_errors.SerializationFailure, pg_errors.LockNotAvailable, pg_errors.DeadlockDetected)
+
+MAX_RIDE_BATCH_SIZE = 1000
+MAX_CONTACT_BATCH_SIZE = 1000
+
+
+class _RideSettlementError(Exception):
+    """Carries a failed ride's response out of its savepoint so the savepoint is rolled back."""
+
+    def __init__(self, body, status):
+        super().__init__(body, status)
+        self.body = body
+        self.status = status
+
+
+class ContactRegistrationController(CaramApiController):
 
     def _get_wallet_accounts(self, env, company_id, contact_type, coupon_value=0):
         """Get and validate wallet accounts for a given contact type"""
-        company = env["res.company"].sudo().browse(company_id)
+        # Accounts are resolved and validated once per company by _caram_get_config
+        config = env["res.company"].sudo().browse(company_id)._caram_get_config()
 
         # Get accounts from company configuration
         if coupon_value>0:
-          bank_account = company.caram_bouns_account_id
+          bank_account_id = config["bonus_account_id"]
         else:
-          bank_account = company.caram_bank_account_id
+          bank_account_id = config["bank_account_id"]
 
         if contact_type == "rider":
-            liability_account = company.caram_rider_wallets_account_id
+            liability_account_id = config["rider_wallet_account_id"]
         elif contact_type == "driver":
-            liability_account = company.caram_driver_wallet_account_id
+            liability_account_id = config["driver_wallet_account_id"]
         else:
-            liability_account = False
+            liability_account_id = False
 
         # Validate accounts exist
-        if not bank_account:
+        if not bank_account_id:
             return None, None, request.make_json_response({"error": "Bank account not configured in company settings"}, status=500)
-        if not liability_account:
+        if not liability_account_id:
             return None, None, request.make_json_response({"error": f"{contact_type.capitalize()} wallet account not configured in company settings"}, status=500)
 
         # Validate account companies
-        for account in (bank_account, liability_account):
-            if account:
-                if not account.exists():
-                    return None, None, request.make_json_response({"error": "Account not found or invalid"}, status=500)
-                # Check if account is accessible by the company
-                if not account.company_ids or company_id not in account.company_ids.ids:
-                    return None, None, request.make_json_response({"error": "Bank account company mismatch"}, status=500)
+        for account_id in (bank_account_id, liability_account_id):
+            if account_id in config["account_errors"]:
+                return None, None, request.make_json_response({"error": config["account_errors"][account_id]}, status=500)
 
-        return bank_account, liability_account, None
+        Account = env["account.account"].sudo()
+        return Account.browse(bank_account_id), Account.browse(liability_account_id), None
 
 
     def create_driver_coupon_credit_note(self, env, company_id, partner, amount):
         """Create & post a customer credit note to represent the welcome coupon."""
-        product_coupon = env['product.product'].sudo().with_company(company_id).search(
-            [('is_coupon', '=', True)],
-            limit=1,
-        )
-        if not product_coupon:
-            return False
-
-        expense_account = (
-            product_coupon.property_account_expense_id
-            or product_coupon.categ_id.property_account_expense_id
-        )
-        if not expense_account:
-            expense_account = env['account.account'].sudo().with_company(company_id).search(
-                [('company_id', '=', company_id), ('account_type', 'in', ('expense'))],
-                limit=1,
-            )
-        if not expense_account:
-            return False
-
-        credit_note = env['account.move'].sudo().with_company(company_id).create({
-            'partner_id': partner.id,
-            'move_type': 'out_refund',
-            'invoice_date': fields.Date.today(),
-            'invoice_line_ids': [(0, 0, {
-                'product_id': product_coupon.id,
-                'account_id': expense_account.id,
-                'name': 'Welcome Coupon - Service Credit',
-                'quantity': 1,
-                'price_unit': amount,
-            })],
-
-            'is_from_api': True,
-})
-        
-        # Post the credit note to make it effective
-        credit_note.action_post()
-        return credit_note
+        return self.create_driver_coupon_credit_notes(env, company_id, {partner: amount}).get(partner, False)
+
+    def create_driver_coupon_credit_notes(self, env, company_id, amounts_by_partner):
+        """Create & post the welcome coupon credit notes of {partner: amount} in one batch.
+
+        Returns: {partner: credit note}, empty when the coupon product is not configured.
+        """
+        config = env['res.company'].sudo().browse(company_id)._caram_get_config()
+        if not amounts_by_partner or not config['coupon_product_id'] or not config['coupon_expense_account_id']:
+            return {}
+
+        partners = list(amounts_by_partner)
+        credit_notes = env['account.move'].sudo().with_company(company_id).create([
+            {
+                'partner_id': partner.id,
+                'move_type': 'out_refund',
+                'invoice_date': fields.Date.today(),
+                'invoice_line_ids': [(0, 0, {
+                    'product_id': config['coupon_product_id'],
+                    'account_id': config['coupon_expense_account_id'],
+                    'name': 'Welcome Coupon - Service Credit',
+                    'quantity': 1,
+                    'price_unit': amounts_by_partner[partner],
+                })],
+                'is_from_api': True,
+            }
+            for partner in partners
+        ])
+
+        # Post the credit notes to make them effective
+        credit_notes.action_post()
+        return dict(zip(partners, credit_notes))
     
     @http.route("/api/register_contact", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
     def register_contact(self, **kw):
         try:
             payload = json.loads(request.httprequest.data.decode("utf-8"))
@@ -144,42 +134,33 @@ class ContactRegistrationController(http.Controller):
             if contact_type and contact_type not in ["driver", "rider"]:
                 return request.make_json_response({"error": "Invalid contact_type"}, status=400)
 
-            # -------------------- Check Existing Contact --------------------
-            domain = []
-            if sub_id:
-                domain.append(('sub_id', '=', sub_id))
-            if mobile:
-                domain.append(('mobile', '=', mobile))
-
-            domain.append(('company_id', '=', company_id))
-            existing = env["res.partner"].sudo().search(domain, limit=1)
-
-            if existing:
-                return request.make_json_response({"error": "Contact with this email or mobile already exists"}, status=409)
-            else:
-                # -------------------- Create Contact --------------------
-                partner_vals = {
-                    "name": name,
-                    "sub_id": sub_id,
-                    "email": email,
-                    "mobile": mobile,
-                    "phone": mobile,
-                    "city": city,
-                    "gender": gender,
-                    "contact_type": contact_type,
-                    "company_id": company_id,
-                    "customer_rank": 1,
-                    "type": "contact",
-                    "user_id": user.id,
-                }
+            # -------------------- Create Contact --------------------
+            partner_vals = {
+                "name": name,
+                "sub_id": sub_id,
+                "email": email,
+                "mobile": mobile,
+                "phone": mobile,
+                "city": city,
+                "gender": gender,
+                "contact_type": contact_type,
+                "company_id": company_id,
+                "customer_rank": 1,
+                "type": "contact",
+                "user_id": user.id,
+            }
 
-                partner = env["res.partner"].sudo().create(partner_vals)
+            # (sub_id, company_id) is unique in the database: no pre-check, no race
+            try:
+                with env.cr.savepoint():
+                    partner = env["res.partner"].sudo().create(partner_vals)
+            except pg_errors.UniqueViolation:
+                return request.make_json_response({"error": "Contact with this sub_id already exists"}, status=409)
 
             # -------------------- Create Wallet --------------------
-            program = env["loyalty.program"].sudo().search([
-                ("program_type", "=", "ewallet"),
-                ("company_id", "=", company_id),
-            ], limit=1)
+            program = env["loyalty.program"].sudo().browse(
+                env["res.company"].sudo().browse(company_id)._caram_get_config()["ewallet_program_id"]
+            )
 
             if not program:
                 return request.make_json_response({"error": "e-Wallet program not found"}, status=500)
@@ -220,6 +201,8 @@ class ContactRegistrationController(http.Controller):
             return request.make_json_response({"error": str(e)}, status=500)
 
     @http.route("/api/update_contact", type="http", auth="none", methods=["PUT"], csrf=False)
+    @instrumented
+    @idempotent
     def update_contact(self, **kw):
         try:
             payload = json.loads(request.httprequest.data.decode("utf-8"))
@@ -253,9 +236,9 @@ class ContactRegistrationController(http.Controller):
             if partner_id:
                 domain.append(('id', '=', partner_id))
             elif email:
-                domain.append(('email', '=', email))
+                domain.append(('caram_email_normalized', '=', normalize_email(email)))
             elif mobile:
-                domain.append(('mobile', '=', mobile))
+                domain.append(('caram_mobile_normalized', '=', normalize_mobile(mobile)))
 
             partner = env['res.partner'].sudo().search(domain, limit=1)
 
@@ -305,7 +288,190 @@ class ContactRegistrationController(http.Controller):
         except Exception as e:
             return request.make_json_response({"error": f"Failed to update contact: {str(e)}"}, status=500)
 
+    @http.route("/api/contacts/bulk_upsert", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
+    def bulk_upsert_contacts(self, **kw):
+        """Create or update contacts keyed by sub_id.
+
+        Existing contacts get the update_contact semantics (only the given fields are written);
+        new ones get a partner, a wallet and their welcome coupon like register_contact, with
+        one multi-row create per model and one batch of coupon credit notes.
+        """
+        try:
+            payload = json.loads(request.httprequest.data.decode("utf-8"))
+            user = self._authenticate()
+            env = self._get_env(user)
+            company_id = user.company_id.id
+
+            contacts_payload = payload.get("contacts")
+            if not contacts_payload or not isinstance(contacts_payload, list):
+                return request.make_json_response({"error": "contacts is required"}, status=400)
+            if len(contacts_payload) > MAX_CONTACT_BATCH_SIZE:
+                return request.make_json_response(
+                    {"error": f"At most {MAX_CONTACT_BATCH_SIZE} contacts can be upserted per request"}, status=400
+                )
+
+            # -------------------- Validate every contact --------------------
+            results = []
+            valid = []
+            seen = set()
+            for contact in contacts_payload:
+                values, error = self._parse_contact_payload(contact)
+                if not error and values["sub_id"] in seen:
+                    error = "Duplicate sub_id in request"
+                if error:
+                    results.append({"sub_id": values.get("sub_id"), "status": "error", "error": error})
+                    continue
+                seen.add(values["sub_id"])
+                results.append(None)
+                valid.append((len(results) - 1, values))
+
+            # -------------------- Existing contacts (one IN query) --------------------
+            Partner = env["res.partner"].sudo()
+            existing = {
+                partner.sub_id: partner
+                for partner in Partner.search([("sub_id", "in", [values["sub_id"] for _i, values in valid]), ("company_id", "=", company_id)])
+            }
+
+            # Resolve the wallet program before anything is written
+            program = env["loyalty.program"].sudo()
+            if any(values["sub_id"] not in existing for _index, values in valid):
+                program = program.browse(env["res.company"].sudo().browse(company_id)._caram_get_config()["ewallet_program_id"])
+                if not program:
+                    return request.make_json_response({"error": "e-Wallet program not found"}, status=500)
+
+            # A concurrent registration of the same sub_id rolls the whole batch back
+            try:
+                with env.cr.savepoint():
+                    # -------------------- Update existing contacts --------------------
+                    # Contacts receiving the same values are written together
+                    to_write = {}
+                    to_create = []
+                    for index, values in valid:
+                        partner = existing.get(values["sub_id"])
+                        if not partner:
+                            if not values["name"]:
+                                results[index] = {"sub_id": values["sub_id"], "status": "error", "error": "name is required"}
+                                continue
+                            to_create.append((index, values))
+                            continue
+                        update_vals = self._prepare_contact_update_vals(values)
+                        if update_vals:
+                            key = tuple(sorted(update_vals.items()))
+                            to_write[key] = to_write.get(key, Partner) | partner
+                        results[index] = {"sub_id": values["sub_id"], "status": "updated", "odoo_partner_id": partner.id}
+                    for key, partners in to_write.items():
+                        partners.write(dict(key))
+
+                    # -------------------- Create new contacts and their wallets --------------------
+                    if to_create:
+                        partners = Partner.create([
+                            {
+                                "name": values["name"],
+                                "sub_id": values["sub_id"],
+                                "email": values["email"],
+                                "mobile": values["mobile"],
+                                "phone": values["mobile"],
+                                "city": values["city"],
+                                "gender": values["gender"],
+                                "contact_type": values["contact_type"],
+                                "company_id": company_id,
+                                "customer_rank": 1,
+                                "type": "contact",
+                                "user_id": user.id,
+                            }
+                            for _index, values in to_create
+                        ])
+                        cards = env["loyalty.card"].sudo().create([
+                            {"program_id": program.id, "partner_id": partner.id} for partner in partners
+                        ])
+
+                        # -------------------- Welcome coupons (one batch of credit notes) --------------------
+                        coupons = {
+                            partner: values["coupon_value"]
+                            for (_index, values), partner in zip(to_create, partners)
+                            if values["coupon_value"] > 0
+                        }
+                        credit_notes = self.create_driver_coupon_credit_notes(env, company_id, coupons)
+                        cards_by_partner = dict(zip(partners, cards))
+                        env["loyalty.history"].sudo().create([
+                            {
+                                "card_id": cards_by_partner[partner].id,
+                                "description": "Welcome Coupon - Service Credit",
+                                "issued": coupons[partner],
+                                "order_model": "account.move",
+                                "order_id": credit_note.id,
+                                "status": "posted",
+                            }
+                            for partner, credit_note in credit_notes.items()
+                        ])
+                        by_value = {}
+                        for partner, coupon_value in coupons.items():
+                            by_value[coupon_value] = by_value.get(coupon_value, cards.browse()) | cards_by_partner[partner]
+                        for coupon_value, value_cards in by_value.items():
+                            value_cards.write({"points": coupon_value})
+
+                        for (index, values), partner, card in zip(to_create, partners, cards):
+                            results[index] = {
+                                "sub_id": values["sub_id"],
+                                "status": "created",
+                                "odoo_partner_id": partner.id,
+                                "wallet_id": card.id,
+                                "wallet_balance": coupons.get(partner, 0.0),
+                            }
+
+            except pg_errors.UniqueViolation:
+                return request.make_json_response(
+                    {"error": "A contact with one of these sub_ids was created concurrently, retry the request"}, status=409
+                )
+
+            return request.make_json_response({"status": "success", "results": results}, status=200)
+
+        except CONCURRENCY_ERRORS as e:
+            return self._concurrency_failure(e)
+        except Exception as e:
+            return request.make_json_response({"error": f"Failed to upsert contacts: {str(e)}"}, status=500)
+
+    def _parse_contact_payload(self, payload):
+        """Extract and validate one contact of a bulk upsert. Returns: (values, error_message)."""
+        if not isinstance(payload, dict):
+            return {}, "contact must be an object"
+        values = {
+            "sub_id": payload.get("sub_id"),
+            "name": payload.get("name"),
+            "email": payload.get("email"),
+            "mobile": payload.get("mobile"),
+            "city": payload.get("city"),
+            "gender": payload.get("gender"),
+            "contact_type": payload.get("contact_type"),
+        }
+        if not values["sub_id"]:
+            return values, "sub_id is required"
+        if values["gender"] and values["gender"] not in ["male", "female"]:
+            return values, "Invalid gender"
+        if values["contact_type"] and values["contact_type"] not in ["driver", "rider"]:
+            return values, "Invalid contact_type"
+        try:
+            values["coupon_value"] = float(payload.get("coupon_value") or 0.0)
+        except (TypeError, ValueError):
+            return values, "Invalid coupon_value"
+        return values, None
+
+    def _prepare_contact_update_vals(self, values):
+        """update_contact semantics: write only the fields that were given."""
+        update_vals = {}
+        for field_name in ("name", "email", "city", "gender", "contact_type"):
+            if values.get(field_name):
+                update_vals[field_name] = values[field_name]
+        if values.get("mobile"):
+            update_vals["mobile"] = values["mobile"]
+            update_vals["phone"] = values["mobile"]
+        return update_vals
+
     @http.route("/api/add_wallet_transaction", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
     def add_wallet_transaction(self, **kw):
         try:
             payload = json.loads(request.httprequest.data.decode("utf-8"))
@@ -343,9 +509,10 @@ class ContactRegistrationController(http.Controller):
                 return request.make_json_response({"error": "Partner not found or does not belong to this company"}, status=404)
 
             # -------------------- Find Wallet --------------------
-            wallet = env['loyalty.card'].sudo().search([('partner_id', '=', partner.id)], limit=1)
+            wallet = partner.sudo().caram_wallet_card_id
             if not wallet:
                 return request.make_json_response({"error": "Wallet not found for this partner"}, status=404)
+            wallet._caram_lock()
 
 
             contact_type = partner.contact_type
@@ -416,18 +583,11 @@ class ContactRegistrationController(http.Controller):
                 transaction = env['loyalty.history'].sudo().create(transaction_vals)
             
 
-                # Calculate balance: sum of issued minus sum of used for posted records
-                posted_history = env['loyalty.history'].sudo().search([
-                ('card_id', '=', wallet.id), 
-                ('status', '=', 'posted')
-            ])
-                total_issued = sum(posted_history.mapped('issued') or [0.0])
-                total_used = sum(posted_history.mapped('used') or [0.0])
-                total_balance = total_issued - total_used
+                # Posted balance is maintained on the card by loyalty.history
+                total_balance = wallet.caram_get_posted_balance()
 
             # -------------------- Update Card Points --------------------
-                wallet_balance = total_balance
-                wallet.sudo().write({"points": wallet_balance})
+                wallet.sudo().write({"points": wallet.caram_get_available_balance()})
 
             # -------------------- Response --------------------
                 data = {
@@ -444,10 +604,14 @@ class ContactRegistrationController(http.Controller):
 
                 return request.make_json_response({"status": "success", "message": "Wallet transaction created successfully", "data": data}, status=201)
 
+        except CONCURRENCY_ERRORS as e:
+            return self._concurrency_failure(e)
         except Exception as e:
             return request.make_json_response({"error": f"Failed to create wallet transaction: {str(e)}"}, status=500)
 
     @http.route("/api/wallet_withdraw", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
     def wallet_withdraw(self, **kw):
         try:
             payload = json.loads(request.httprequest.data.decode("utf-8"))
@@ -476,20 +640,16 @@ class ContactRegistrationController(http.Controller):
             if not partner:
                 return request.make_json_response({"error": "Partner not found"}, status=404)
 
-            wallet = env['loyalty.card'].sudo().search([('partner_id', '=', partner.id), ('company_id', '=', company_id)], limit=1)
-            if not wallet:
+            wallet = partner.sudo().caram_wallet_card_id
+            if not wallet or wallet.company_id.id != company_id:
                 return request.make_json_response({"error": "No wallet found for this partner"}, status=404)
 
             net_amount = amount
             
-            # Calculate balance: sum of issued minus sum of used for posted records
-            posted_history = env['loyalty.history'].sudo().search([
-                ('card_id', '=', wallet.id), 
-                ('status', '=', 'posted')
-            ])
-            total_issued = sum(posted_history.mapped('issued') or [0.0])
-            total_used = sum(posted_history.mapped('used') or [0.0])
-            total_balance = total_issued - total_used
+            # Lock the wallet first: a concurrent withdrawal for the same partner queues here,
+            # and pending (draft) withdrawals are already reserved from the balance
+            wallet._caram_lock()
+            total_balance = wallet.caram_get_available_balance()
             
             if net_amount > total_balance:
                 return request.make_json_response({"error": "Insufficient wallet balance"}, status=409)
@@ -542,7 +702,7 @@ class ContactRegistrationController(http.Controller):
                 })
             
             transaction = env['loyalty.history'].sudo().create(transaction_vals)
-            balance_after = total_balance - net_amount
+            balance_after = wallet.caram_get_available_balance()
             
             # -------------------- Update Card Points --------------------
             wallet.sudo().write({"points": balance_after})
@@ -555,94 +715,306 @@ class ContactRegistrationController(http.Controller):
 
             return request.make_json_response({"status": "success", "message": "Withdrawal transaction created successfully", "data": data}, status=201)
 
+        except CONCURRENCY_ERRORS as e:
+            return self._concurrency_failure(e)
         except Exception as e:
             return request.make_json_response({"error": f"Failed to create withdrawal transaction: {str(e)}"}, status=500)
 
 
-    @http.route("/api/ride/pay", type="http", auth="none", methods=["POST"], csrf=False)
-    def pay_ride(self, **kw):
+    @http.route("/api/wallet_balance_at", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    def wallet_balance_at(self, **kw):
         try:
             payload = json.loads(request.httprequest.data.decode("utf-8"))
             user = self._authenticate()
             env = self._get_env(user)
             company_id = user.company_id.id
-            fare_amount = float(payload.get("fare_amount"))
-            ride_id = payload.get("ride_id")
-            wallet_paid = payload.get("wallet_paid", 0.0)
-            cash_paid = payload.get("cash_paid", 0.0)
-            commission_amount = payload.get("commission_amount", 0.0)
-            penalties = payload.get("penalties", []) or []
-            rider_id = payload.get("rider_id")
-            driver_id = payload.get("driver_id") or payload.get("driver")
-            payment_mode = payload.get("payment_mode")
-
-            if not payment_mode:
-                return request.make_json_response({"error": "payment_mode is required"}, status=400)
-                
-            if payment_mode not in ["cash_only", "cash_exceed", "wallet_paid", "wallet_cash"]:
-                return request.make_json_response({"error": "Invalid payment_mode"}, status=400)
-                
-            if not ride_id:
-                return request.make_json_response({"error": "ride_id is required"}, status=400)
 
-            if fare_amount <= 0:
-                return request.make_json_response({"error": "fare_amount must be > 0"}, status=400)
+            # -------------------- Extract Data --------------------
+            date = payload.get("date")
+            partner_ids = payload.get("odoo_partner_ids") or []
 
-            # wallet_paid can be 0.0 (e.g. cash-only rides)
-            if wallet_paid is None or float(wallet_paid) < 0:
-                return request.make_json_response({"error": "wallet_paid is required and must be >= 0"}, status=400)
-                
-            #if not commission_amount or commission_amount <= 0:
-                #return request.make_json_response({"error": "commission_amount is required"}, status=400)
+            # -------------------- Validate required fields --------------------
+            if not date:
+                return request.make_json_response({"error": "date is required"}, status=400)
+            try:
+                date = fields.Date.to_date(date)
+            except ValueError:
+                return request.make_json_response({"error": "date must be in YYYY-MM-DD format"}, status=400)
+            if not partner_ids or not isinstance(partner_ids, list):
+                return request.make_json_response({"error": "odoo_partner_ids is required"}, status=400)
+
+            # -------------------- Find Wallets --------------------
+            wallets = env['res.partner'].sudo().browse(partner_ids).exists().caram_wallet_card_id.filtered(
+                lambda wallet: wallet.company_id.id == company_id
+            )
+            balances = wallets.caram_get_balances_at(date)
+
+            data = [
+                {
+                    "partner_id": wallet.partner_id.id,
+                    "wallet_id": wallet.id,
+                    "balance": balances.get(wallet.id, 0.0),
+                }
+                for wallet in wallets
+            ]
+
+            return request.make_json_response({"status": "success", "date": fields.Date.to_string(date), "data": data}, status=200)
 
-            if not rider_id:
-                return request.make_json_response({"error": "rider_id is required"}, status=400)
+        except Exception as e:
+            return request.make_json_response({"error": f"Failed to compute wallet balances: {str(e)}"}, status=500)
+
+    @http.route("/api/driver/earnings", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    def driver_earnings(self, **kw):
+        try:
+            payload = json.loads(request.httprequest.data.decode("utf-8"))
+            user = self._authenticate()
+            env = self._get_env(user)
+            company_id = user.company_id.id
+
+            # -------------------- Extract Data --------------------
+            driver_id = payload.get("driver_id")
+            period = payload.get("period") or "day"
+            today = fields.Date.context_today(env.user)
+
+            # -------------------- Validate required fields --------------------
             if not driver_id:
                 return request.make_json_response({"error": "driver_id is required"}, status=400)
+            if period not in ("day", "week"):
+                return request.make_json_response({"error": "period must be 'day' or 'week'"}, status=400)
+            try:
+                date_to = fields.Date.to_date(payload.get("date_to")) or today
+                date_from = fields.Date.to_date(payload.get("date_from")) or date_to - timedelta(days=6)
+            except ValueError:
+                return request.make_json_response({"error": "dates must be in YYYY-MM-DD format"}, status=400)
+            if date_from > date_to:
+                return request.make_json_response({"error": "date_from must be before date_to"}, status=400)
 
-            # -------------------- Find Rider and Driver --------------------
-            rider = env["res.partner"].sudo().browse(rider_id)
             driver = env["res.partner"].sudo().browse(driver_id)
-            if not rider.exists():
-                return request.make_json_response({"error": "Rider not found"}, status=404)
             if not driver.exists():
                 return request.make_json_response({"error": "Driver not found"}, status=404)
 
-            # -------------------- Find Ride --------------------
-            ride = env["caram.ride"].sudo().search(
-                [("ride_id", "=", ride_id), ("company_id", "=", company_id)], limit=1
+            # -------------------- Read the daily summary --------------------
+            rows, totals = env["caram.driver.earnings"].sudo().caram_get_earnings(
+                driver, company_id, date_from, date_to, period
             )
-            if not ride:
-                ride = env["caram.ride"].sudo().with_company(company_id).create(
-                    {
-                        "ride_id": ride_id,
-                        "company_id": company_id,
-                        "rider_id": rider.id,
-                        "driver_id": driver.id,
-                        "fare_amount": fare_amount,
-                        "commission_amount": commission_amount,
-                        "wallet_paid": wallet_paid,
-                        "cash_paid": cash_paid,
-                    }
-                )
-            try:
+            return request.make_json_response({
+                "status": "success",
+                "driver_id": driver.id,
+                "period": period,
+                "date_from": fields.Date.to_string(date_from),
+                "date_to": fields.Date.to_string(date_to),
+                "data": rows,
+                "totals": totals,
+            }, status=200)
+
+        except Exception as e:
+            return request.make_json_response({"error": f"Failed to read driver earnings: {str(e)}"}, status=500)
+
+    def _parse_ride_payload(self, payload):
+        """Extract and validate one ride payment. Returns: (values, error_message)."""
+        fare_amount = float(payload.get("fare_amount"))
+        values = {
+            "ride_id": payload.get("ride_id"),
+            "fare_amount": fare_amount,
+            "wallet_paid": payload.get("wallet_paid", 0.0),
+            "cash_paid": payload.get("cash_paid", 0.0),
+            "commission_amount": payload.get("commission_amount", 0.0),
+            "penalties": payload.get("penalties", []) or [],
+            "rider_id": payload.get("rider_id"),
+            "driver_id": payload.get("driver_id") or payload.get("driver"),
+            "payment_mode": payload.get("payment_mode"),
+        }
+
+        if not values["payment_mode"]:
+            return values, "payment_mode is required"
+            
+        if values["payment_mode"] not in ["cash_only", "cash_exceed", "wallet_paid", "wallet_cash"]:
+            return values, "Invalid payment_mode"
+            
+        if not values["ride_id"]:
+            return values, "ride_id is required"
+
+        if fare_amount <= 0:
+            return values, "fare_amount must be > 0"
+
+        # wallet_paid can be 0.0 (e.g. cash-only rides)
+        if values["wallet_paid"] is None or float(values["wallet_paid"]) < 0:
+            return values, "wallet_paid is required and must be >= 0"
+            
+        #if not commission_amount or commission_amount <= 0:
+            #return values, "commission_amount is required"
+
+        if not values["rider_id"]:
+            return values, "rider_id is required"
+        if not values["driver_id"]:
+            return values, "driver_id is required"
+        return values, None
+
+    def _settle_ride(self, env, company_id, values, rider, driver, ride=None, rider_card=None, driver_card=None):
+        """Create the ride if needed and pay it. Returns: (response body, HTTP status)."""
+        try:
+            with caram_phase("settle"):
+                if not ride:
+                    # Rejected with "Ride already paid." when the ride_id was archived
+                    ride = env["caram.ride"].sudo().with_company(company_id).create(
+                        {
+                            "ride_id": values["ride_id"],
+                            "company_id": company_id,
+                            "rider_id": rider.id,
+                            "driver_id": driver.id,
+                            "fare_amount": values["fare_amount"],
+                            "commission_amount": values["commission_amount"],
+                            "wallet_paid": values["wallet_paid"],
+                            "cash_paid": values["cash_paid"],
+                        }
+                    )
                 result = ride.action_pay_ride(
-                    fare_amount=fare_amount,
-                    wallet_paid=wallet_paid,
-                    cash_paid=cash_paid,
-                    commission_amount=commission_amount,
-                    penalties=penalties,
-                    payment_mode=payment_mode,
+                    fare_amount=values["fare_amount"],
+                    wallet_paid=values["wallet_paid"],
+                    cash_paid=values["cash_paid"],
+                    commission_amount=values["commission_amount"],
+                    penalties=values["penalties"],
+                    payment_mode=values["payment_mode"],
+                    rider_card=rider_card,
+                    driver_card=driver_card,
                 )
-            except UserError as e:
-                msg = str(e)
-                if "Insufficient wallet balance" in msg:
-                    return request.make_json_response(
-                        {"status": "error", "code": "INSUFFICIENT_WALLET_BALANCE"}, status=409
+        except UserError as e:
+            msg = str(e)
+            if "Insufficient wallet balance" in msg:
+                return {"status": "error", "code": "INSUFFICIENT_WALLET_BALANCE"}, 409
+            return {"error": msg}, 400
+        return result, 200
+
+    @http.route("/api/ride/pay", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
+    def pay_ride(self, **kw):
+        try:
+            payload = json.loads(request.httprequest.data.decode("utf-8"))
+            user = self._authenticate()
+            env = self._get_env(user)
+            company_id = user.company_id.id
+
+            values, error = self._parse_ride_payload(payload)
+            if error:
+                return request.make_json_response({"error": error}, status=400)
+
+            with caram_phase("lookup"):
+                # -------------------- Find Rider and Driver --------------------
+                rider = env["res.partner"].sudo().browse(values["rider_id"])
+                driver = env["res.partner"].sudo().browse(values["driver_id"])
+                if not rider.exists():
+                    return request.make_json_response({"error": "Rider not found"}, status=404)
+                if not driver.exists():
+                    return request.make_json_response({"error": "Driver not found"}, status=404)
+
+                # -------------------- Find Ride --------------------
+                ride = env["caram.ride"].sudo().search(
+                    [("ride_id", "=", values["ride_id"]), ("company_id", "=", company_id)], limit=1
+                )
+            body, status = self._settle_ride(env, company_id, values, rider, driver, ride=ride)
+            return request.make_json_response(body, status=status)
+
+        except CONCURRENCY_ERRORS as e:
+            return self._concurrency_failure(e)
+        except Exception as e:
+            return request.make_json_response({"error": f"Failed to pay ride: {str(e)}"}, status=500)
+
+    @http.route("/api/ride/pay_batch", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
+    def pay_ride_batch(self, **kw):
+        try:
+            payload = json.loads(request.httprequest.data.decode("utf-8"))
+            user = self._authenticate()
+            env = self._get_env(user)
+            company_id = user.company_id.id
+
+            rides_payload = payload.get("rides")
+            if not rides_payload or not isinstance(rides_payload, list):
+                return request.make_json_response({"error": "rides is required"}, status=400)
+            if len(rides_payload) > MAX_RIDE_BATCH_SIZE:
+                return request.make_json_response(
+                    {"error": f"At most {MAX_RIDE_BATCH_SIZE} rides can be settled per request"}, status=400
+                )
+
+            # -------------------- Validate every ride --------------------
+            parsed = []
+            seen = set()
+            for ride_payload in rides_payload:
+                try:
+                    values, error = self._parse_ride_payload(ride_payload)
+                except (TypeError, ValueError, AttributeError) as e:
+                    values, error = {"ride_id": isinstance(ride_payload, dict) and ride_payload.get("ride_id")}, str(e)
+                if not error and values["ride_id"] in seen:
+                    error = "Duplicate ride_id in request"
+                if not error:
+                    seen.add(values["ride_id"])
+                parsed.append((values, error))
+            valid = [values for values, error in parsed if not error]
+
+            # -------------------- Resolve partners, wallets and rides (one query each) --------------------
+            with caram_phase("lookup"):
+                partner_ids = {values["rider_id"] for values in valid} | {values["driver_id"] for values in valid}
+                partners = env["res.partner"].sudo().browse(list(partner_ids)).exists()
+                cards_by_partner = {}
+                for partner in partners:
+                    if partner.caram_wallet_card_id:
+                        cards_by_partner[partner.id] = partner.caram_wallet_card_id
+                rides_by_ref = {
+                    ride.ride_id: ride
+                    for ride in env["caram.ride"].sudo().search(
+                        [("ride_id", "in", [values["ride_id"] for values in valid]), ("company_id", "=", company_id)]
                     )
-                return request.make_json_response({"error": msg}, status=400)
+                }
+                # Lock every wallet of the batch once, in id order, before settling any ride
+                env["loyalty.card"].sudo().browse([card.id for card in cards_by_partner.values()])._caram_lock()
+
+            # -------------------- Settle each ride in its own savepoint --------------------
+            results = []
+            for values, error in parsed:
+                if error:
+                    results.append({"ride_id": values.get("ride_id"), "status": "error", "status_code": 400, "error": error})
+                    continue
+                rider = partners.browse(values["rider_id"])
+                driver = partners.browse(values["driver_id"])
+                if rider not in partners:
+                    results.append({"ride_id": values["ride_id"], "status": "error", "status_code": 404, "error": "Rider not found"})
+                    continue
+                if driver not in partners:
+                    results.append({"ride_id": values["ride_id"], "status": "error", "status_code": 404, "error": "Driver not found"})
+                    continue
+                try:
+                    with env.cr.savepoint():
+                        body, status = self._settle_ride(
+                            env,
+                            company_id,
+                            values,
+                            rider,
+                            driver,
+                            ride=rides_by_ref.get(values["ride_id"]),
+                            rider_card=cards_by_partner.get(rider.id),
+                            driver_card=cards_by_partner.get(driver.id),
+                        )
+                        if status != 200:
+                            # Roll back whatever the failed ride wrote (e.g. its new caram.ride row)
+                            raise _RideSettlementError(body, status)
+                except _RideSettlementError as e:
+                    body, status = e.body, e.status
+                except CONCURRENCY_ERRORS:
+                    raise
+                except Exception as e:
+                    body, status = {"error": f"Failed to pay ride: {str(e)}"}, 500
+                if status == 200:
+                    results.append(dict(body, status_code=status))
+                else:
+                    results.append(dict(body, ride_id=values["ride_id"], status="error", status_code=status))
 
-            return request.make_json_response(result, status=200)
+            return request.make_json_response({"status": "success", "results": results}, status=200)
 
+        except CONCURRENCY_ERRORS as e:
+            return self._concurrency_failure(e)
         except Exception as e:
-            return request.make_json_response({"error": f"Failed to pay ride: {str(e)}"}, status=500)
\ No newline at end of file
+            return request.make_json_response({"error": f"Failed to pay rides: {str(e)}"}, status=500)
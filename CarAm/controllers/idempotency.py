@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import functools
+
+from odoo.exceptions import UserError
+from odoo.http import request
+
+from .base import caram_phase
+
+
+def idempotent(endpoint):
+    """Replay the stored response when a request is retried with the same `Idempotency-Key`.
+
+    Responses below 500 are stored in the request transaction, so a retry after a client
+    timeout gets the original result without running the endpoint (and its accounting) again.
+    Keys are scoped to the authenticated API user; unauthenticated requests and requests
+    without the header are processed as before, without claiming anything.
+    """
+
+    @functools.wraps(endpoint)
+    def wrapper(self, *args, **kwargs):
+        httprequest = request.httprequest
+        key = httprequest.headers.get("Idempotency-Key")
+        if not key:
+            return endpoint(self, *args, **kwargs)
+
+        try:
+            user = self._authenticate()
+        except UserError:
+            # The endpoint answers with its own authentication error, which is never stored
+            return endpoint(self, *args, **kwargs)
+
+        with caram_phase("idempotency"):
+            store = request.env["caram.idempotency.key"].sudo()
+            request_hash = store._caram_request_hash(
+                httprequest.method, httprequest.path, httprequest.headers.get("Authorization"), httprequest.get_data()
+            )
+            claimed, record = store._caram_claim(user, key, httprequest.path, request_hash)
+        if not claimed:
+            if record.request_hash != request_hash:
+                return request.make_json_response(
+                    {"error": "Idempotency-Key was already used with a different request"}, status=422
+                )
+            if not record.status_code:
+                return request.make_json_response(
+                    {"error": "A request with this Idempotency-Key is still being processed"}, status=409
+                )
+            response = request.make_response(
+                record.response_body,
+                headers=[("Content-Type", "application/json; charset=utf-8"), ("Idempotent-Replayed", "true")],
+                status=record.status_code,
+            )
+            return response
+
+        response = endpoint(self, *args, **kwargs)
+        if response.status_code < 500:
+            record._caram_store_response(response.status_code, response.get_data(as_text=True))
+        else:
+            # Let the client retry a failed request with the same key (the claim is gone if
+            # the endpoint rolled the transaction back)
+            record.exists().unlink()
+        return response
+
+    return wrapper
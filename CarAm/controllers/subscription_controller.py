@@ -3,42 +3,20 @@
 from odoo import http
 from odoo.http import request
 from odoo.exceptions import UserError, ValidationError
+from psycopg2 import errors as pg_errors
 import json
 
+from .base import CaramApiController, instrumented
+from .idempotency import idempotent
 
 
-class SubscriptionController(http.Controller):
-    """Controller for subscription management APIs"""
 
-    def _authenticate(self):
-        """Validate Bearer Token and return the user"""
-
-        auth = request.httprequest.headers.get("Authorization")
-        if not auth or not auth.startswith("Bearer "):
-            raise UserError("Missing or invalid Authorization header")
-        
-        token = auth.split(" ")[1]
-        user_id = request.env["res.users.apikeys"]._check_credentials(
-            scope="api", key=token
-        )
-        if not user_id:
-            raise UserError("Invalid API token")
-        
-        return request.env["res.users"].sudo().browse(int(user_id))
-
-    def _get_env(self, user):
-        """Get environment with company context"""
-        company = user.company_id
-        return request.env(
-            user=user,
-            context=dict(
-                request.env.context,
-                allowed_company_ids=[company.id],
-                company_id=company.id,
-            )
-        )
+class SubscriptionController(CaramApiController):
+    """Controller for subscription management APIs"""
 
     @http.route("/api/create_subscription", type="http", auth="none", methods=["POST"], csrf=False)
+    @instrumented
+    @idempotent
     def create_subscription(self, **kw):
         """Create subscription, invoice, and pay from wallet"""
         try:
@@ -86,26 +64,33 @@ class SubscriptionController(http.Controller):
             # Check for existing subscription
             existing = env['sale.order'].sudo().search([
                 ('caram_subscription_id', '=', caram_subscription_id),
+                ('company_id', '=', company_id),
                 ('plan_id', '!=', False),  # Only check orders with plan_id (subscriptions)
             ], limit=1)
-            # if existing:
-            #     return request.make_json_response({'error': 'Subscription with this caram_subscription_id already exists'}, status=409)
+            if existing:
+                return request.make_json_response({'error': 'Subscription with this caram_subscription_id already exists'}, status=409)
 
             # # Get partner
             partner = env['res.partner'].sudo().browse(odoo_partner_id)
             if not partner.exists():
                 return request.make_json_response({'error': 'Partner not found'}, status=404)
 
+            # (caram_subscription_id, company_id) is unique in the database, which also covers
+            # a concurrent request for the same subscription
             subscription_model = env['sale.order']
-            result = subscription_model.create_subscription_with_invoice(
-                partner_id=partner.id,
-                caram_subscription_id=caram_subscription_id,
-                subscription_type=subscription_type,
-                price=price,
-                start_date=start_date,
-                end_date=end_date,
-                company_id=company_id,
-            )
+            try:
+                with env.cr.savepoint():
+                    result = subscription_model.create_subscription_with_invoice(
+                        partner_id=partner.id,
+                        caram_subscription_id=caram_subscription_id,
+                        subscription_type=subscription_type,
+                        price=price,
+                        start_date=start_date,
+                        end_date=end_date,
+                        company_id=company_id,
+                    )
+            except pg_errors.UniqueViolation:
+                return request.make_json_response({'error': 'Subscription with this caram_subscription_id already exists'}, status=409)
 
             if result.get('error'):
                 return request.make_json_response(result, status=result.get('status_code', 500))
@@ -11,3 +11,13 @@ from . import sale_subscription_plan
 from . import product_template
 from . import caram_ride
 from . import loyalty_card
+from . import caram_wallet_checkpoint
+from . import caram_commission_accrual
+from . import loyalty_program
+from . import account_account
+from . import caram_idempotency_key
+from . import caram_accounting_job
+from . import caram_ride_archive
+from . import caram_driver_earnings
+from . import caram_status_outbox
+from . import res_users_apikeys
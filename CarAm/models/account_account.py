@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+
+class AccountAccount(models.Model):
+    _inherit = "account.account"
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"company_ids", "active", "account_type"}.intersection(vals):
+            self.env["res.company"]._caram_invalidate_config()
+        return res
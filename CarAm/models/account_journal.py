@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields
+from odoo import api, models, fields
 
 
 class AccountJournal(models.Model):
@@ -19,3 +19,19 @@ class AccountJournal(models.Model):
         ('tele', 'Tele')
     ], string="Wallet Type", help="Used to categorize journals for wallet transaction")
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        journals = super().create(vals_list)
+        self.env["res.company"]._caram_invalidate_config()
+        return journals
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"type", "company_id", "journal_sub_type", "is_used_for_subscriptions", "active", "sequence"}.intersection(vals):
+            self.env["res.company"]._caram_invalidate_config()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env["res.company"]._caram_invalidate_config()
+        return res
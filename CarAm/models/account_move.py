@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields
+from odoo.tools.sql import create_index
 
 
 class AccountMove(models.Model):
@@ -14,3 +15,65 @@ class AccountMove(models.Model):
         readonly=True,
     )
 
+    caram_wallet_history_ids = fields.One2many(
+        "loyalty.history",
+        "caram_move_id",
+        string="Wallet Transactions",
+        readonly=True,
+    )
+
+
+class AccountMoveLine(models.Model):
+    _inherit = "account.move.line"
+
+    def init(self):
+        super().init()
+        # Open customer credits, looked up when a wallet pays an invoice
+        create_index(
+            self.env.cr,
+            "account_move_line_caram_open_credit_idx",
+            self._table,
+            ["partner_id", "account_id", "date", "id"],
+            where="reconciled IS NOT TRUE AND amount_residual < 0 AND parent_state = 'posted'",
+        )
+
+    def _caram_get_wallet_credit_lines(self, amount, exclude=None):
+        """Return the oldest open wallet credits of this receivable line's partner covering `amount`.
+
+        Only credits of CarAm wallet documents (API payments and credit notes) on the same
+        account are considered; the last one may be used partially by the reconciliation.
+        """
+        self.ensure_one()
+        if amount <= 0:
+            return self.browse()
+        self.env["account.move.line"].flush_model(["partner_id", "account_id", "amount_residual", "reconciled", "parent_state"])
+        self.env.cr.execute(
+            """
+            SELECT id
+              FROM (
+                    SELECT aml.id,
+                           SUM(-aml.amount_residual) OVER (ORDER BY aml.date, aml.id) + aml.amount_residual AS covered
+                      FROM account_move_line aml
+                      JOIN account_move move ON move.id = aml.move_id
+                 LEFT JOIN account_payment payment ON payment.move_id = aml.move_id
+                     WHERE aml.partner_id = %(partner_id)s
+                       AND aml.account_id = %(account_id)s
+                       AND aml.company_id = %(company_id)s
+                       AND aml.reconciled IS NOT TRUE
+                       AND aml.amount_residual < 0
+                       AND aml.parent_state = 'posted'
+                       AND aml.id != ALL(%(exclude_ids)s)
+                       AND (payment.is_from_api OR move.is_from_api)
+                   ) credit
+             WHERE covered < %(amount)s
+          ORDER BY id
+            """,
+            {
+                "partner_id": self.partner_id.id,
+                "account_id": self.account_id.id,
+                "company_id": self.company_id.id,
+                "exclude_ids": [self.id, *(exclude.ids if exclude else [])],
+                "amount": amount,
+            },
+        )
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
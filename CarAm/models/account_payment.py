@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields
+from odoo import api, models, fields, tools
 from odoo.exceptions import UserError
-from cryptography.fernet import Fernet
+from odoo.tools import str2bool
 import base64
-import requests
 import logging
 
+from .caram_api_client import CaramApiClient
+
 _logger = logging.getLogger(__name__)
 
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+
+# Last API client built by this worker for each database, closed when it is replaced
+_caram_api_clients = {}
+
 class AccountPayment(models.Model):
     _inherit = "account.payment"
 
@@ -35,64 +41,35 @@ class AccountPayment(models.Model):
         readonly=True,
         copy=False,
     )
+    caram_wallet_history_ids = fields.One2many(
+        "loyalty.history",
+        "caram_payment_id",
+        string="Wallet Transactions",
+        readonly=True,
+    )
 
 
-    def _get_caram_api_url(self):
-        """Get CarAm API base URL from settings"""
-
-        base_url = self.env['ir.config_parameter'].sudo().get_param(
-            'caram.api.base.url', 
-            'https://staging.caram.app'
-        )
-        return f"{base_url}/api/change-transaction-status"
-
-    def _get_caram_api_headers(self):
-        """Return headers for CarAm API requests.
+    @api.model
+    @tools.ormcache()
+    def _caram_api_client(self):
+        """Per-worker CarAm API client; ir.config_parameter changes clear the registry cache.
 
-        If `caram.api.token` is set in system parameters, it will be used as a Bearer token.
+        The client it replaces is closed, so its pooled connections are released right away.
         """
-        headers = {
-            'Accept': 'application/json',
-        }
-        token = self.env['ir.config_parameter'].sudo().get_param('caram.api.token')
-        if token:
-            headers['Authorization'] = f'Bearer {token}'
-        return headers
-
-    def _prepare_caram_status_payload(self, status):
-        """Prepare CarAm payload for change-transaction-status endpoint including encrypted attachment."""
-
-        self.ensure_one()
-
-        # Validations
-        if not status or status not in ['confirm', 'decline']:
-            raise UserError('Only posted or cancelled entries can be synced with CarAm')
-        if not self.caram_transaction_id:
-            raise UserError('Transaction ID is required')
-
-        payload = {
-            'transaction_id': self.caram_transaction_id,
-            'status': status,
-        }
-
-        if self.caram_bank:
-            payload['bank'] = self.caram_bank
-        if self.caram_account_number:
-            payload['account_number'] = self.caram_account_number
-
-        # Encrypt caram_attachment if exists
-        if self.caram_attachment:
-            encrypted_attachment = self._encrypt_attachment(self.caram_attachment)
-            payload['attachment'] = encrypted_attachment
-            payload['attachment_filename'] = self.caram_attachment_name or 'attachment'
-
-        if status == 'decline':
-            payload['decline_reason'] = self.caram_decline_reason or 'Transaction cancelled'
-        _logger.info(f"Payload: {payload}")
-        return payload
+        params = self.env['ir.config_parameter'].sudo()
+        client = CaramApiClient(
+            params.get_param('caram.api.base.url', 'https://staging.caram.app'),
+            token=params.get_param('caram.api.token'),
+            shared_secret=params.get_param('caram.shared_secret'),
+        )
+        previous = _caram_api_clients.get(self.env.cr.dbname)
+        _caram_api_clients[self.env.cr.dbname] = client
+        if previous is not None:
+            previous.close()
+        return client
 
     def _prepare_caram_status_payload(self, status):
-        """Prepare CarAm payload including encrypted attachment (AES)."""
+        """Prepare CarAm payload including the encrypted attachment, unless it is streamed (see _caram_deliver_status)."""
 
         self.ensure_one()
 
@@ -111,9 +88,8 @@ class AccountPayment(models.Model):
         if self.caram_account_number:
             payload['account_number'] = self.caram_account_number
 
-        # Encrypt attachment
-        if self.caram_attachment:
-            payload['attachment'] = self._encrypt_attachment(self.caram_attachment)
+        if self.caram_attachment and not self._caram_stream_attachments():
+            payload['attachment'] = self._encrypt_attachment_base64()
             payload['attachment_filename'] = self.caram_attachment_name or 'attachment'
 
         if status == 'decline':
@@ -123,94 +99,159 @@ class AccountPayment(models.Model):
         return payload
 
 
-    def _encrypt_attachment(self, attachment_binary):
-        """Encrypt attachment using shared secret (AES / Fernet)."""
+    @api.model
+    def _caram_stream_attachments(self):
+        """Whether attachments are streamed as multipart `fernet-chunks` (caram.api.stream_attachments)."""
+        return str2bool(self.env['ir.config_parameter'].sudo().get_param('caram.api.stream_attachments', 'False'))
 
+    def _caram_attachment_record(self):
+        """Return the ir.attachment holding caram_attachment, without loading its content."""
         self.ensure_one()
+        return self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_field', '=', 'caram_attachment'),
+            ('res_id', '=', self.id),
+        ], limit=1)
+
+    def _caram_iter_attachment_chunks(self, chunk_size=ATTACHMENT_CHUNK_SIZE):
+        """Yield the raw attachment content in chunks, read straight from the filestore."""
+        attachment = self._caram_attachment_record()
+        if attachment.store_fname:
+            with open(attachment._full_path(attachment.store_fname), 'rb') as file:
+                while chunk := file.read(chunk_size):
+                    yield chunk
+        elif attachment.db_datas:
+            data = attachment.raw
+            for start in range(0, len(data), chunk_size):
+                yield data[start:start + chunk_size]
+
+    def _encrypt_attachment(self):
+        """Encrypt the attachment using shared secret (AES / Fernet), one chunk at a time.
+
+        Yields one Fernet token per chunk, each followed by a newline; the platform decrypts
+        the tokens in order and concatenates them.
+        """
+        self.ensure_one()
+        client = self._caram_api_client()
+        for chunk in self._caram_iter_attachment_chunks():
+            yield client.encrypt(chunk) + b'\n'
 
-        secret = self.env['ir.config_parameter'].sudo().get_param('caram.shared_secret')
-        if not secret:
-            raise UserError("Missing shared secret for CarAm encryption")
-
-        fernet = Fernet(secret.encode())
-
-        file_bytes = base64.b64decode(attachment_binary)
-        encrypted_bytes = fernet.encrypt(file_bytes)
+    def _encrypt_attachment_base64(self):
+        """Encrypt the whole attachment in one Fernet token, base64 encoded for the JSON payload."""
+        self.ensure_one()
+        file_bytes = b''.join(self._caram_iter_attachment_chunks())
+        return base64.b64encode(self._caram_api_client().encrypt(file_bytes)).decode()
 
-        return base64.b64encode(encrypted_bytes).decode()
+    def _send_caram_status_update(self, status):
+        """Queue a status update for the CarAm platform.
 
-                
+        The message is written to the outbox in the current transaction and delivered by a
+        cron after commit, so posting never waits on the CarAm API.
+        """
+        self.env['caram.status.outbox']._caram_enqueue(self, status)
+        return True
 
-    def _send_caram_status_update(self, status):
-        """Send status update to CarAm platform."""
+    def _caram_deliver_status(self, status):
+        """Send status update to CarAm platform (called by the outbox cron)."""
         self.ensure_one()
 
-        api_url = self._get_caram_api_url()
         payload = self._prepare_caram_status_payload(status)
-        
-        try:
-            response = requests.post(api_url, json=payload, timeout=10, headers=self._get_caram_api_headers())
-            response.raise_for_status()
-            
-            # Mark as synced
-            self.sudo().write({'caram_status_synced': True})
-            
-            return {
-                'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': 'Success',
-                    'message': f'Status updated successfully on CarAm platform',
-                    'type': 'success',
-                    'sticky': False,
-                }
-            }
-        except requests.exceptions.HTTPError as e:
-            raise UserError(f'Failed to update status on CarAm: {str(e)}')
+        client = self._caram_api_client()
+        if self._caram_stream_attachments() and self._caram_attachment_record():
+            # multipart/form-data streamed from the filestore, never the whole file in memory
+            payload['attachment_encoding'] = 'fernet-chunks'
+            response = client.post_multipart(
+                '/api/change-transaction-status',
+                payload,
+                'attachment',
+                self.caram_attachment_name or 'attachment',
+                self._encrypt_attachment(),
+            )
+        else:
+            response = client.post('/api/change-transaction-status', json=payload)
+        response.raise_for_status()
+        return response
+
+    def _caram_deliver_status_bulk(self, status):
+        """Send `status` for all these payments in one request to the bulk endpoint.
+
+        Returns: {caram_transaction_id: error message, or False when the platform accepted it}
+        """
+        results = {}
+        payloads = []
+        stream_attachments = self._caram_stream_attachments()
+        for payment in self:
+            if stream_attachments and payment._caram_attachment_record():
+                # Attachments are streamed as multipart, which the bulk JSON body cannot carry
+                try:
+                    payment._caram_deliver_status(status)
+                    results[payment.caram_transaction_id] = False
+                except Exception as e:
+                    results[payment.caram_transaction_id] = str(e)
+                continue
+            try:
+                payloads.append(payment._prepare_caram_status_payload(status))
+            except Exception as e:
+                results[payment.caram_transaction_id] = str(e)
+        if not payloads:
+            return results
+
+        response = self._caram_api_client().post(
+            '/api/change-transaction-status/bulk',
+            json={'transactions': payloads},
+            timeout=30,
+        )
+        response.raise_for_status()
+        returned = {
+            item.get('transaction_id'): item
+            for item in (response.json().get('results') or [])
+        }
+        for payload in payloads:
+            item = returned.get(payload['transaction_id'])
+            if not item:
+                results[payload['transaction_id']] = 'No result returned by CarAm'
+            elif item.get('success'):
+                results[payload['transaction_id']] = False
+            else:
+                results[payload['transaction_id']] = item.get('error') or 'Rejected by CarAm'
+        return results
 
 
     def action_post(self):
         """Override to automatically sync status on post"""
 
         result = super().action_post()
-        for move in self:
-            if move.caram_transaction_id:
-                try:
-                    move._send_caram_status_update('confirm')
-                    transaction = self.env['loyalty.history'].sudo().search(
-                        [('order_id', '=', move.id)],
-                          limit=1
-                        )
-
-                    _logger.info(
-                    "NOT FOUND | No loyalty.history for move %s",
-                    move.id
-                )
-                    if not transaction:
-                        continue
-
-                    transaction.write({'status': 'posted'})
-
-                    # -------------------- Update Card Points --------------------
-                    card = transaction.card_id
-                    if card:
-                        new_balance = card.points + transaction.issued
-                        card.write({'points': new_balance})
-                        _logger.info(
-                    "NOT FOUND | No loyalty.history for move %s",
-                    new_balance
-                )
-                except Exception as e:
-                    _logger.warning(f"Failed to sync CarAm status on post: {str(e)}")
+        caram_payments = self.filtered("caram_transaction_id")
+        # One indexed lookup for the wallet rows of every payment being posted
+        transactions = self.env['loyalty.history'].sudo().search(
+            [('caram_payment_id', 'in', caram_payments.ids)]
+        )
+        caram_payments._send_caram_status_update('confirm')
+        transactions.card_id._caram_lock()
+        for move in caram_payments:
+            transaction = transactions.filtered(lambda t: t.caram_payment_id == move)[:1]
+            if not transaction:
+                _logger.info("NOT FOUND | No loyalty.history for payment %s", move.id)
+                continue
+
+            transaction.write({'status': 'posted'})
+
+            # -------------------- Update Card Points --------------------
+            card = transaction.card_id
+            if card:
+                card.write({'points': card.caram_get_available_balance()})
         return result
 
     def action_cancel(self):
         """Override to automatically sync status on cancel"""
         result = super().action_cancel()
-        for move in self:
-            if move.caram_transaction_id:
-                try:
-                    move._send_caram_status_update('decline')
-                except Exception as e:
-                    _logger.warning(f"Failed to sync CarAm status on cancel: {str(e)}")
-        return result
\ No newline at end of file
+        # Release the wallet amounts reserved by the draft rows of the cancelled payments
+        transactions = self.env['loyalty.history'].sudo().search(
+            [('caram_payment_id', 'in', self.ids), ('status', '=', 'draft')]
+        )
+        transactions.card_id._caram_lock()
+        transactions.write({'status': 'cancel'})
+        for card in transactions.card_id:
+            card.write({'points': card.caram_get_available_balance()})
+        self.filtered('caram_transaction_id')._send_caram_status_update('decline')
+        return result
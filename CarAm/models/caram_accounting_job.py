@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+import logging
+_logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY_MINUTES = 2
+
+
+class CaramAccountingJob(models.Model):
+    _name = "caram.accounting.job"
+    _description = "CarAm Deferred Accounting Job"
+    _order = "id desc"
+    _rec_name = "ride_id"
+
+    ride_id = fields.Many2one("caram.ride", string="Ride", required=True, index=True, readonly=True, ondelete="cascade")
+    company_id = fields.Many2one("res.company", required=True, readonly=True)
+    job_type = fields.Selection([("ride_documents", "Ride Documents")], required=True, default="ride_documents", readonly=True)
+    payload = fields.Json(readonly=True, help="Accounting documents to create, as described by the ride payment.")
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done"), ("dead", "Failed")],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    attempts = fields.Integer(readonly=True)
+    next_attempt_at = fields.Datetime(readonly=True, index=True, default=fields.Datetime.now)
+    last_error = fields.Text(readonly=True)
+
+    @api.model
+    def _caram_enqueue(self, ride, documents):
+        job = self.create({
+            "ride_id": ride.id,
+            "company_id": ride.company_id.id,
+            "payload": documents,
+        })
+        self.env.ref("CarAm.ir_cron_caram_accounting_jobs")._trigger()
+        return job
+
+    def _caram_run(self):
+        self.ensure_one()
+        ride = self.ride_id.with_company(self.company_id.id)
+        ride._caram_create_documents(self.payload or [])
+
+    @api.model
+    def _cron_caram_process_jobs(self, limit=100):
+        """Create the accounting documents of the pending jobs, one transaction per job.
+
+        Jobs are picked with SKIP LOCKED so concurrent workers never process the same job. A
+        failing job is retried with an exponential backoff and parked as 'Failed' after
+        MAX_ATTEMPTS; the wallet transactions stay posted either way.
+        """
+        processed = 0
+        while processed < limit:
+            self.env.cr.execute(
+                """
+                SELECT id
+                  FROM caram_accounting_job
+                 WHERE state = 'pending'
+                   AND next_attempt_at <= now() AT TIME ZONE 'UTC'
+              ORDER BY next_attempt_at, id
+                 LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+                """
+            )
+            row = self.env.cr.fetchone()
+            if not row:
+                break
+            job = self.browse(row[0])
+            processed += 1
+            try:
+                with self.env.cr.savepoint():
+                    job._caram_run()
+                job.write({"state": "done", "attempts": job.attempts + 1, "last_error": False})
+            except Exception as e:
+                attempts = job.attempts + 1
+                _logger.warning("CarAm: accounting job %s failed (attempt %s): %s", job.id, attempts, e)
+                vals = {"attempts": attempts, "last_error": str(e)}
+                if attempts >= MAX_ATTEMPTS:
+                    vals["state"] = "dead"
+                else:
+                    vals["next_attempt_at"] = fields.Datetime.now() + timedelta(
+                        minutes=RETRY_DELAY_MINUTES * 2 ** (attempts - 1)
+                    )
+                job.write(vals)
+            self.env.cr.commit()
+        return processed
+
+    def action_retry(self):
+        self.filtered(lambda j: j.state == "dead").write({
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt_at": fields.Datetime.now(),
+        })
+        self.env.ref("CarAm.ir_cron_caram_accounting_jobs")._trigger()
+        return True
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from cryptography.fernet import Fernet
+import requests
+import uuid
+from requests.adapters import HTTPAdapter
+
+from odoo import _
+from odoo.exceptions import UserError
+
+DEFAULT_TIMEOUT = 10
+
+
+class CaramApiClient:
+    """Keep-alive HTTP client for the CarAm API.
+
+    Built once per worker from the `caram.*` system parameters (see
+    `account.payment._caram_api_client`) and dropped whenever a parameter changes.
+    """
+
+    def __init__(self, base_url, token=None, shared_secret=None, pool_size=10):
+        self.base_url = (base_url or "").rstrip("/")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/json"
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        self._shared_secret = shared_secret
+        self._fernet = None
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def post(self, path, **kwargs):
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return self.session.post(self.url(path), **kwargs)
+
+    def post_multipart(self, path, fields, file_field, filename, chunks, **kwargs):
+        """POST multipart/form-data whose file part is produced by the `chunks` iterable.
+
+        The body is a generator, so requests sends it with chunked transfer encoding and
+        only one chunk is held in memory at a time.
+        """
+        boundary = uuid.uuid4().hex
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+        return self.session.post(
+            self.url(path),
+            data=_multipart_body(boundary, fields, file_field, filename, chunks),
+            headers=headers,
+            **kwargs,
+        )
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            if not self._shared_secret:
+                raise UserError(_("Missing shared secret for CarAm encryption"))
+            self._fernet = Fernet(self._shared_secret.encode())
+        return self._fernet
+
+    def encrypt(self, data):
+        return self.fernet.encrypt(data)
+
+    def close(self):
+        self.session.close()
+
+
+def _multipart_body(boundary, fields, file_field, filename, chunks):
+    filename = filename.replace('"', "")
+    for name, value in fields.items():
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+            f'{value}\r\n'
+        ).encode()
+    yield (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    yield from chunks
+    yield f'\r\n--{boundary}--\r\n'.encode()
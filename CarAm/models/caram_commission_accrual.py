@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class CaramCommissionAccrual(models.Model):
+    _name = "caram.commission.accrual"
+    _description = "CarAm Commission / Fine Accrual"
+    _order = "date desc, id desc"
+
+    partner_id = fields.Many2one("res.partner", required=True, index=True, readonly=True)
+    company_id = fields.Many2one("res.company", required=True, readonly=True)
+    currency_id = fields.Many2one(related="company_id.currency_id", readonly=True)
+    card_id = fields.Many2one("loyalty.card", string="Wallet", required=True, readonly=True, ondelete="cascade")
+    history_id = fields.Many2one("loyalty.history", string="Wallet Transaction", readonly=True, ondelete="set null")
+    kind = fields.Selection([("commission", "Commission"), ("fine", "Fine")], required=True, readonly=True)
+    amount = fields.Monetary(required=True, readonly=True)
+    date = fields.Date(required=True, readonly=True, default=fields.Date.context_today)
+    invoice_id = fields.Many2one("account.move", string="Invoice", readonly=True, copy=False)
+    state = fields.Selection(
+        [("pending", "Pending"), ("invoiced", "Invoiced")],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+
+    @api.model
+    def _caram_accrue(self, card, partner, commission_amount, fine_amount, history=None):
+        """Record the commission/fine of one wallet withdrawal instead of invoicing it."""
+        vals_list = []
+        for kind, amount in (("commission", commission_amount), ("fine", fine_amount)):
+            if amount > 0:
+                vals_list.append({
+                    "partner_id": partner.id,
+                    "company_id": card.company_id.id,
+                    "card_id": card.id,
+                    "history_id": history.id if history else False,
+                    "kind": kind,
+                    "amount": amount,
+                })
+        return self.sudo().create(vals_list)
+
+    @api.model
+    def _caram_period_start(self, company, today):
+        if company.caram_invoice_period == "weekly":
+            return today - timedelta(days=today.weekday())
+        return today
+
+    @api.model
+    def _cron_caram_invoice_accruals(self, batch_size=200):
+        """Issue one posted invoice per partner for the accruals of every closed period."""
+        today = fields.Date.context_today(self)
+        for company in self.env["res.company"].sudo().search([("caram_invoice_mode", "=", "periodic")]):
+            accruals = self.sudo().search([
+                ("company_id", "=", company.id),
+                ("state", "=", "pending"),
+                ("date", "<", self._caram_period_start(company, today)),
+            ])
+            by_partner = defaultdict(lambda: self.sudo())
+            for accrual in accruals:
+                by_partner[accrual.partner_id] |= accrual
+            partners = list(by_partner)
+            for start in range(0, len(partners), batch_size):
+                batch = partners[start:start + batch_size]
+                try:
+                    self._caram_invoice_partners(company, {p: by_partner[p] for p in batch})
+                except Exception:
+                    # Leave the batch pending for the next run, go on with the others
+                    self.env.cr.rollback()
+                    _logger.exception(
+                        "CarAm: consolidated invoicing of partners %s failed for %s", [p.id for p in batch], company.name
+                    )
+                    continue
+                self.env.cr.commit()
+
+    @api.model
+    def _caram_invoice_partners(self, company, accruals_by_partner):
+        """Create and post the consolidated invoices of {partner: accruals} in one batch."""
+        invoice_vals_list = []
+        for partner, accruals in accruals_by_partner.items():
+            card = accruals[0].card_id
+            date_from, date_to = min(accruals.mapped("date")), max(accruals.mapped("date"))
+            line_vals_list = []
+            for kind, prepare in (
+                ("commission", card._prepare_commission_invoice_line_vals),
+                ("fine", card._prepare_fine_invoice_line_vals),
+            ):
+                kind_accruals = accruals.filtered(lambda a: a.kind == kind)
+                if not kind_accruals:
+                    continue
+                line_vals = prepare(sum(kind_accruals.mapped("amount")))
+                line_vals["name"] = _("%(name)s (%(count)s rides, %(date_from)s - %(date_to)s)") % {
+                    "name": line_vals["name"],
+                    "count": len(kind_accruals),
+                    "date_from": date_from,
+                    "date_to": date_to,
+                }
+                line_vals_list.append(line_vals)
+            invoice_vals_list.append({
+                "invoice_date": fields.Date.today(),
+                "journal_id": card._get_general_journal(),
+                "move_type": "out_invoice",
+                "partner_id": partner.id,
+                "invoice_line_ids": [(0, 0, vals) for vals in line_vals_list],
+                "is_from_api": True,
+            })
+
+        invoices = self.env["account.move"].sudo().with_company(company.id).create(invoice_vals_list)
+        invoices.action_post()
+
+        for (partner, accruals), invoice in zip(accruals_by_partner.items(), invoices):
+            accruals.write({"invoice_id": invoice.id, "state": "invoiced"})
+            accruals.history_id.write({"order_model": "account.move", "order_id": invoice.id})
+        _logger.info("CarAm: issued %s consolidated commission invoice(s) for %s", len(invoices), company.name)
+        return invoices
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+EARNINGS_FIELDS = ("ride_count", "fare_amount", "wallet_amount", "cash_amount", "commission_amount", "penalty_amount", "net_amount")
+
+
+class CaramDriverEarnings(models.Model):
+    _name = "caram.driver.earnings"
+    _description = "CarAm Driver Daily Earnings"
+    _order = "date desc, id desc"
+    _rec_name = "driver_id"
+
+    _sql_constraints = [
+        ("driver_company_date_uniq", "unique(driver_id, company_id, date)", "Only one earnings row per driver and day is allowed."),
+    ]
+
+    driver_id = fields.Many2one("res.partner", string="Driver", required=True, readonly=True, ondelete="cascade")
+    company_id = fields.Many2one("res.company", required=True, readonly=True)
+    currency_id = fields.Many2one(related="company_id.currency_id", readonly=True)
+    date = fields.Date(required=True, readonly=True)
+    ride_count = fields.Integer(readonly=True)
+    fare_amount = fields.Monetary(readonly=True)
+    wallet_amount = fields.Monetary(readonly=True, help="Part of the fares paid from the rider wallet.")
+    cash_amount = fields.Monetary(readonly=True, help="Part of the fares paid in cash.")
+    commission_amount = fields.Monetary(readonly=True)
+    penalty_amount = fields.Monetary(readonly=True)
+    net_amount = fields.Monetary(readonly=True, help="Fares minus commission and penalties.")
+
+    @api.model
+    def _caram_add_ride(self, ride, wallet_amount, commission_amount, penalty_amount):
+        """Add one paid ride to the earnings of its driver for today, with a single upsert."""
+        fare_amount = ride.fare_amount
+        self.env.cr.execute(
+            """
+            INSERT INTO caram_driver_earnings
+                        (driver_id, company_id, date, ride_count, fare_amount, wallet_amount, cash_amount,
+                         commission_amount, penalty_amount, net_amount,
+                         create_uid, create_date, write_uid, write_date)
+                 VALUES (%(driver_id)s, %(company_id)s, %(date)s, 1, %(fare)s, %(wallet)s, %(cash)s,
+                         %(commission)s, %(penalty)s, %(net)s,
+                         %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC')
+            ON CONFLICT (driver_id, company_id, date) DO UPDATE
+                    SET ride_count = caram_driver_earnings.ride_count + 1,
+                        fare_amount = caram_driver_earnings.fare_amount + EXCLUDED.fare_amount,
+                        wallet_amount = caram_driver_earnings.wallet_amount + EXCLUDED.wallet_amount,
+                        cash_amount = caram_driver_earnings.cash_amount + EXCLUDED.cash_amount,
+                        commission_amount = caram_driver_earnings.commission_amount + EXCLUDED.commission_amount,
+                        penalty_amount = caram_driver_earnings.penalty_amount + EXCLUDED.penalty_amount,
+                        net_amount = caram_driver_earnings.net_amount + EXCLUDED.net_amount,
+                        write_uid = EXCLUDED.write_uid,
+                        write_date = EXCLUDED.write_date
+            """,
+            {
+                "driver_id": ride.driver_id.id,
+                "company_id": ride.company_id.id,
+                "date": fields.Date.context_today(self),
+                "fare": fare_amount,
+                "wallet": wallet_amount,
+                "cash": fare_amount - wallet_amount,
+                "commission": commission_amount,
+                "penalty": penalty_amount,
+                "net": fare_amount - commission_amount - penalty_amount,
+                "uid": self.env.uid,
+            },
+        )
+        self.invalidate_model()
+
+    @api.model
+    def caram_get_earnings(self, driver, company_id, date_from, date_to, period="day"):
+        """Return the earnings of `driver` between both dates (included), per day or per ISO week.
+
+        Returns: (rows, totals) where every row has a `date` (first day of the week in weekly mode).
+        """
+        records = self.search_read(
+            [
+                ("driver_id", "=", driver.id),
+                ("company_id", "=", company_id),
+                ("date", ">=", date_from),
+                ("date", "<=", date_to),
+            ],
+            ["date", *EARNINGS_FIELDS],
+            order="date",
+        )
+        buckets = {}
+        for record in records:
+            date = record["date"]
+            if period == "week":
+                date -= timedelta(days=date.weekday())
+            bucket = buckets.setdefault(date, dict.fromkeys(EARNINGS_FIELDS, 0))
+            for name in EARNINGS_FIELDS:
+                bucket[name] += record[name]
+
+        rows = [dict(values, date=fields.Date.to_string(date)) for date, values in buckets.items()]
+        totals = dict.fromkeys(EARNINGS_FIELDS, 0)
+        for row in rows:
+            for name in EARNINGS_FIELDS:
+                totals[name] += row[name]
+        return rows, totals
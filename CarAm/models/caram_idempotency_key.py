@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import hashlib
+
+from odoo import api, fields, models
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class CaramIdempotencyKey(models.Model):
+    _name = "caram.idempotency.key"
+    _description = "CarAm API Idempotency Key"
+    _rec_name = "key"
+
+    _sql_constraints = [
+        ("user_key_endpoint_uniq", "unique(user_id, key, endpoint)", "Idempotency key already used for this endpoint."),
+    ]
+
+    user_id = fields.Many2one("res.users", string="API User", readonly=True, ondelete="cascade")
+    key = fields.Char(required=True, readonly=True)
+    endpoint = fields.Char(required=True, readonly=True)
+    request_hash = fields.Char(required=True, readonly=True)
+    status_code = fields.Integer(readonly=True, help="Empty while the original request is still being processed.")
+    response_body = fields.Text(readonly=True)
+    expires_at = fields.Datetime(required=True, readonly=True, index=True)
+
+    @api.model
+    def _caram_request_hash(self, method, path, authorization, body):
+        """Fingerprint a request; the token is part of it so a key cannot replay another caller's response."""
+        digest = hashlib.sha256()
+        for part in (method, path, authorization or ""):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        digest.update(body or b"")
+        return digest.hexdigest()
+
+    @api.model
+    def _caram_claim(self, user, key, endpoint, request_hash):
+        """Claim `key` of API `user` for this request, or return the row of the request that already used it.
+
+        The claim is inserted in the request transaction: a concurrent request with the same key
+        waits on the unique index until the first one finishes and is then retried by the
+        dispatcher, at which point it finds the stored response.
+
+        Returns: (claimed, record)
+        """
+        ttl_hours = int(self.env["ir.config_parameter"].sudo().get_param("caram.idempotency.ttl_hours", 24))
+        self.env.cr.execute(
+            """
+            INSERT INTO caram_idempotency_key
+                        (user_id, key, endpoint, request_hash, expires_at, create_uid, create_date, write_uid, write_date)
+                 VALUES (%(user_id)s, %(key)s, %(endpoint)s, %(hash)s, %(expires_at)s,
+                         %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC')
+            ON CONFLICT (user_id, key, endpoint) DO NOTHING
+              RETURNING id
+            """,
+            {
+                "user_id": user.id,
+                "key": key,
+                "endpoint": endpoint,
+                "hash": request_hash,
+                "expires_at": fields.Datetime.now() + timedelta(hours=ttl_hours),
+                "uid": self.env.uid,
+            },
+        )
+        row = self.env.cr.fetchone()
+        if row:
+            return True, self.browse(row[0])
+        return False, self.search([("user_id", "=", user.id), ("key", "=", key), ("endpoint", "=", endpoint)], limit=1)
+
+    def _caram_store_response(self, status_code, body):
+        self.ensure_one()
+        self.write({"status_code": status_code, "response_body": body})
+
+    @api.model
+    def _cron_caram_gc_idempotency_keys(self):
+        self.env.cr.execute(
+            "DELETE FROM caram_idempotency_key WHERE expires_at < now() AT TIME ZONE 'UTC'"
+        )
+        _logger.info("CarAm: removed %s expired idempotency key(s)", self.env.cr.rowcount)
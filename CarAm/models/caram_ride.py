@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 
-from odoo import fields, models, _
-from odoo.exceptions import UserError
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools.sql import create_index
 import logging
 _logger = logging.getLogger(__name__)
 
+# API payment_mode -> caram.ride.payment_mode
+PAYMENT_MODE_MAP = {
+    "cash_only": "cash",
+    "cash_exceed": "cash",
+    "wallet_paid": "wallet",
+    "wallet_cash": "mixed",
+}
+
+
 class CaramRide(models.Model):
     _name = "caram.ride"
     _description = "CarAm Ride"
@@ -36,6 +46,18 @@ class CaramRide(models.Model):
     state = fields.Selection([("draft", "Draft"), ("paid", "Paid")], default="draft", index=True)
     paid_at = fields.Datetime(readonly=True)
 
+    def init(self):
+        super().init()
+        create_index(self.env.cr, "caram_ride_paid_at_idx", self._table, ["paid_at"], where="state = 'paid'")
+
+    @api.constrains("ride_id", "company_id")
+    def _check_ride_id_not_archived(self):
+        """unique(ride_id, company_id) only covers this table; archived rides keep their ride_id."""
+        Archive = self.env["caram.ride.archive"].sudo()
+        for ride in self:
+            if Archive.search_count([("ride_id", "=", ride.ride_id), ("company_id", "=", ride.company_id.id)], limit=1):
+                raise ValidationError(_("Ride already paid."))
+
     def _create_journal_entry(self, driver, rider, amount):
         """Create & post a journal entry transferring wallet amount rider -> driver.
 
@@ -53,17 +75,14 @@ class CaramRide(models.Model):
         if not driver_wallet_account:
             raise UserError(_("Driver has no receivable account."))
 
-        journal = self.env["account.journal"].sudo().with_company(self.company_id.id).search(
-            [("company_id", "=", self.company_id.id), ("type", "=", "general")],
-            limit=1,
-        )
-        if not journal:
+        journal_id = self.company_id._caram_get_config()["general_journal_id"]
+        if not journal_id:
             raise UserError(_("No journal found to post CarAm wallet transfer entries."))
 
         ref = f"Ride {self.ride_id} wallet transfer"
         move_vals = {
             "move_type": "entry",
-            "journal_id": journal.id,   
+            "journal_id": journal_id,
             "date": fields.Date.context_today(self),
             "ref": ref,
             "is_from_api": True,
@@ -91,7 +110,7 @@ class CaramRide(models.Model):
         
 
     def _get_wallet_card(self, partner):
-        return self.env["loyalty.card"].sudo().search([("partner_id", "=", partner.id)], limit=1)
+        return partner.sudo().caram_wallet_card_id
 
     def _get_receivable_account(self, partner):
         account = partner.with_company(self.company_id.id).property_account_receivable_id
@@ -105,10 +124,133 @@ class CaramRide(models.Model):
         return account
 
 
+    # ---------------------------
+    # Posting plan
+    # ---------------------------
+    def _caram_plan_line(self, plan, card, amount, description, document=None, accrual=None, order_model=None, order_id=None):
+        """Add one posted wallet row to `plan`; `document` is shared by the rows it will be linked to."""
+        if document is not None and not any(document is d for d in plan["documents"]):
+            plan["documents"].append(document)
+        plan["lines"].append({
+            "card": card,
+            "document": document,
+            "accrual": accrual,
+            "vals": {
+                "card_id": card.id,
+                "description": description or "",
+                "issued": amount,
+                "used": 0.0,
+                "status": "posted",
+                "order_model": order_model,
+                "order_id": order_id,
+            },
+        })
+
+    def _caram_plan_withdraw(self, plan, card, partner, amount, commission_amount, fine_amount, description):
+        """Debit `card` and invoice (or accrue, in periodic invoicing) the commission/fine."""
+        document = accrual = None
+        if self.company_id.caram_invoice_mode == "periodic":
+            accrual = {"partner": partner, "commission_amount": commission_amount, "fine_amount": fine_amount}
+        else:
+            document = {
+                "type": "invoice",
+                "card_id": card.id,
+                "partner_id": partner.id,
+                "commission_amount": commission_amount,
+                "fine_amount": fine_amount,
+            }
+        self._caram_plan_line(plan, card, -amount, description, document=document, accrual=accrual)
+
+    def _caram_plan_deposit(self, plan, card, partner, amount, description):
+        """Credit `card` against a posted cash payment."""
+        document = {
+            "type": "payment",
+            "card_id": card.id,
+            "partner_id": partner.id,
+            "amount": amount,
+            "ref": description or "",
+        }
+        self._caram_plan_line(plan, card, amount, description, document=document)
+
+    def _caram_plan_transfer(self, plan, rider_card, driver_card, amount, rider_description, driver_description):
+        """Move `amount` from the rider wallet to the driver wallet with one transfer entry."""
+        document = {"type": "transfer", "amount": amount}
+        self._caram_plan_line(plan, rider_card, -amount, rider_description, document=document)
+        self._caram_plan_line(plan, driver_card, amount, driver_description, document=document)
+
+    def _caram_apply_posting_plan(self, plan):
+        """Write a posting plan: one loyalty.history create for all rows and one points write per wallet.
+
+        In synchronous accounting the documents are created first, so every row is created with its
+        link; in deferred accounting they are queued with the ids of their rows instead.
+        """
+        deferred = self.company_id.caram_accounting_mode == "deferred"
+        if not deferred:
+            for document in plan["documents"]:
+                order_model, record = self._caram_create_document(document)
+                for line in plan["lines"]:
+                    if line["document"] is document:
+                        line["vals"].update({"order_model": order_model, "order_id": record.id})
+
+        histories = self.env["loyalty.history"].sudo().create([line["vals"] for line in plan["lines"]])
+
+        Accrual = self.env["caram.commission.accrual"]
+        for line, history in zip(plan["lines"], histories):
+            if line["accrual"]:
+                accrual = line["accrual"]
+                Accrual._caram_accrue(
+                    line["card"], accrual["partner"], accrual["commission_amount"], accrual["fine_amount"], history
+                )
+            if deferred and line["document"] is not None:
+                line["document"].setdefault("history_ids", []).append(history.id)
+
+        cards = self.env["loyalty.card"].sudo()
+        for line in plan["lines"]:
+            cards |= line["card"]
+        # Points keep the draft withdrawals reserved (the cards were locked by action_pay_ride)
+        balances = cards._caram_get_available_balances()
+        for card in cards:
+            card.write({"points": balances[card.id]})
+
+        if deferred and plan["documents"]:
+            self.env["caram.accounting.job"].sudo()._caram_enqueue(self, plan["documents"])
+        return histories
+
+    def _caram_create_document(self, document):
+        """Create & post one accounting document of a posting plan.
+
+        Returns: (order_model, record)
+        """
+        self.ensure_one()
+        if document["type"] == "transfer":
+            return "account.move", self._create_journal_entry(self.driver_id, self.rider_id, document["amount"])
+        card = self.env["loyalty.card"].sudo().browse(document["card_id"])
+        partner = self.env["res.partner"].sudo().browse(document["partner_id"])
+        if document["type"] == "invoice":
+            invoice = card._caram_create_withdraw_invoice(partner, document["commission_amount"], document["fine_amount"])
+            return "account.move", invoice
+        if document["type"] == "payment":
+            payment, error = card._create_payment(partner, document["amount"], "cash", document["ref"])
+            if error:
+                raise UserError(error)
+            return "account.payment", payment
+        raise UserError(_("Unknown accounting document type %s") % document["type"])
+
+    def _caram_create_documents(self, documents):
+        """Create the queued documents of a deferred ride payment and link them to their wallet rows."""
+        self.ensure_one()
+        History = self.env["loyalty.history"].sudo()
+        for document in documents:
+            order_model, record = self._caram_create_document(document)
+            History.browse(document["history_ids"]).exists().write({"order_model": order_model, "order_id": record.id})
+
     # ---------------------------
     # Main payment logic
     # ---------------------------
-    def action_pay_ride(self, *,fare_amount, wallet_paid, cash_paid, commission_amount, penalties, payment_mode):
+    def action_pay_ride(self, *,fare_amount, wallet_paid, cash_paid, commission_amount, penalties, payment_mode,
+                        rider_card=None, driver_card=None):
+        """Settle the ride. `rider_card`/`driver_card` may be passed by callers that already
+        resolved the wallets (batch settlement); otherwise they are looked up here."""
         self.ensure_one()
         if self.state == "paid":
             raise UserError(_("Ride already paid."))
@@ -149,198 +291,72 @@ class CaramRide(models.Model):
         driver_wallet_delta = 0.0
         
         # Cards (wallets)
-        rider_card = self._get_wallet_card(self.rider_id)
+        rider_card = rider_card or self._get_wallet_card(self.rider_id)
         if not rider_card:
             raise UserError(_("Wallet not found for rider."))
 
-        driver_card = self._get_wallet_card(self.driver_id)
+        driver_card = driver_card or self._get_wallet_card(self.driver_id)
         if not driver_card:
             raise UserError(_("Wallet not found for driver."))
 
-        # Add fine to rider and driver if exist  
+        # Lock both wallets (always in id order) before any balance is read or written
+        (rider_card | driver_card)._caram_lock()
+        # The rider penalty is debited from the same wallet as the fare
+        rider_debit = rider_penalty_amount
+        if payment_mode in ("wallet_paid", "wallet_cash") and wallet_paid > 0:
+            rider_debit += wallet_paid
+        if rider_debit > 0:
+            rider_card.caram_check_available_balance(rider_debit)
+
+        # Build the whole posting plan first, then write it in one pass
+        plan = {"lines": [], "documents": []}
         if payment_mode == "cash_only":
-            driver_card.caram_withdraw(
-                commission_amount + driver_penalty_amount,
-                commission_amount,
-                fine_amount=driver_penalty_amount,
-                description=f"Ride commission {self.ride_id} (cash)",
-                status="posted",
-                driver=self.driver_id,
-                should_create_invoice=True,
-            )
-            if rider_penalty_amount > 0:
-                rider_card.caram_withdraw(
-                    rider_penalty_amount,
-                    commission_amount= 0.0,
-                    fine_amount=rider_penalty_amount,
-                    description=f"Ride penalty {self.ride_id} (rider)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_invoice=True,
-                )
+            commission_description = f"Ride commission {self.ride_id} (cash)"
 
             rider_wallet_delta = 0.0
             driver_wallet_delta = -commission_amount
 
         elif payment_mode == "cash_exceed":
+            # cash_paid > fare_amount => diff is deposited to rider wallet
             extra = cash_paid - self.fare_amount
-            rider_card.caram_addwallet(
-                extra,
-                description=f"Ride payment {self.ride_id} (wallet)",
-                status="posted",
-                driver=self.rider_id,
-                should_create_payment=True,
-            )
-            
-            driver_card.caram_addwallet(
-                -extra,
-                description=f"Ride payment {self.driver_id} (wallet)",
-                status="posted",
-                driver=self.driver_id,
-                should_create_payment=True,
-            )
-            driver_card.caram_withdraw(
-                commission_amount + driver_penalty_amount,
-                commission_amount,
-                fine_amount=driver_penalty_amount,
-                description=f"Ride commission {self.driver_id} (cash)",
-                status="posted",
-                driver=self.driver_id,
-                should_create_invoice=True,
-            )
-            if rider_penalty_amount > 0:
-                rider_card.caram_withdraw(
-                    rider_penalty_amount,
-                    commission_amount= 0.0,
-                    fine_amount=rider_penalty_amount,
-                    description=f"Ride penalty {self.ride_id} (rider)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_invoice=True,
-                )
+            self._caram_plan_deposit(plan, rider_card, self.rider_id, extra, f"Ride payment {self.ride_id} (wallet)")
+            self._caram_plan_deposit(plan, driver_card, self.driver_id, -extra, f"Ride payment {self.driver_id} (wallet)")
+            commission_description = f"Ride commission {self.driver_id} (cash)"
 
-            # cash_paid > fare_amount => diff is deposited to rider wallet
             rider_wallet_delta = float(cash_paid - self.fare_amount)
             driver_wallet_delta = -commission_amount
 
         elif payment_mode == "wallet_paid":
-            history1 = rider_card.caram_withdraw(
+            # Transfer from rider wallet to driver wallet
+            self._caram_plan_transfer(
+                plan,
+                rider_card,
+                driver_card,
                 wallet_paid,
-                rider_penalty_amount,
-                fine_amount=driver_penalty_amount,
-                description=f"Ride wallet amount {self.ride_id} (wallet)",
-                status="posted",
-                driver=self.rider_id,
-                should_create_invoice=False,
-            )
-
-            history2 = driver_card.caram_addwallet(
-                wallet_paid,
-                description=f"Driver wallet amount {self.driver_id} (wallet)",
-                status="posted",
-                driver=self.driver_id,
-                should_create_payment=False,
-            )
-            # Create Journal Entery
-            # to transfer from rider wallet to driver wallet
-            journal_entry = self._create_journal_entry(self.driver_id, self.rider_id, wallet_paid)
-            history1.sudo().write({
-                "order_model": "account.move",
-                "order_id": journal_entry.id,
-            })
-            history2.sudo().write({
-                "order_model": "account.move",
-                "order_id": journal_entry.id,
-            })
-            driver_card.caram_withdraw(
-                commission_amount + driver_penalty_amount,
-                commission_amount,
-                fine_amount=driver_penalty_amount,
-                description=f"Ride commission {self.ride_id} (cash)",
-                status="posted",
-                driver=self.driver_id,
-                should_create_invoice=True,
+                f"Ride wallet amount {self.ride_id} (wallet)",
+                f"Driver wallet amount {self.driver_id} (wallet)",
             )
-            if rider_penalty_amount > 0:
-                rider_card.caram_withdraw(
-                    rider_penalty_amount,
-                    commission_amount= 0.0,
-                    fine_amount=rider_penalty_amount,
-                    description=f"Ride penalty {self.ride_id} (rider)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_invoice=True,
-                )
+            commission_description = f"Ride commission {self.ride_id} (cash)"
 
             rider_wallet_delta = -self.fare_amount
             driver_wallet_delta = float(self.fare_amount - commission_amount)
 
         elif payment_mode == "wallet_cash":
             if wallet_paid > 0:
-                journal_entry = self._create_journal_entry(self.driver_id, self.rider_id, wallet_paid)
-                history1 = rider_card.caram_withdraw(
+                self._caram_plan_transfer(
+                    plan,
+                    rider_card,
+                    driver_card,
                     wallet_paid,
-                    rider_penalty_amount,
-                    fine_amount=driver_penalty_amount,
-                    description=f"Ride wallet amount {self.ride_id} (wallet part)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_invoice=False,
+                    f"Ride wallet amount {self.ride_id} (wallet part)",
+                    f"Driver wallet amount {self.ride_id} (wallet part)",
                 )
-                history2 = driver_card.caram_addwallet(
-                    wallet_paid,
-                    description=f"Driver wallet amount {self.ride_id} (wallet part)",
-                    status="posted",
-                    driver=self.driver_id,
-                    should_create_payment=False,
-                )
-                history1.sudo().write({
-                    "order_model": "account.move",
-                    "order_id": journal_entry.id,
-                })
-                history2.sudo().write({
-                    "order_model": "account.move",
-                    "order_id": journal_entry.id,
-                })
             diff = fare_amount - wallet_paid
-         
             if cash_paid > diff:
                 due_amount = cash_paid - diff
-                rider_card.caram_addwallet(
-                    due_amount,
-                    description=f"Ride wallet amount {self.ride_id} (cash part)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_payment=True,
-                )
-                driver_card.caram_addwallet(
-                    -due_amount,
-                    description=f"Ride wallet amount {self.ride_id} (cash part)",
-                    status="posted",
-                    driver=self.driver_id,
-                    should_create_payment=True,
-                )
-              
-            if commission_amount >= 0 or driver_penalty_amount>=0:
-                driver_card.caram_withdraw(
-                    commission_amount + driver_penalty_amount,
-                    commission_amount,
-                    fine_amount=driver_penalty_amount,
-                    description=f"Ride commission {self.ride_id} (wallet+cash)",
-                    status="posted",
-                    driver=self.driver_id,
-                    should_create_invoice=True,
-                )
-            if rider_penalty_amount > 0:
-                rider_card.caram_withdraw(
-                    rider_penalty_amount,
-                    commission_amount= 0.0,
-                    fine_amount=rider_penalty_amount,
-                    description=f"Ride penalty {self.ride_id} (rider)",
-                    status="posted",
-                    driver=self.rider_id,
-                    should_create_invoice=True,
-                )
+                self._caram_plan_deposit(plan, rider_card, self.rider_id, due_amount, f"Ride wallet amount {self.ride_id} (cash part)")
+                self._caram_plan_deposit(plan, driver_card, self.driver_id, -due_amount, f"Ride wallet amount {self.ride_id} (cash part)")
+            commission_description = f"Ride commission {self.ride_id} (wallet+cash)"
 
             rider_wallet_delta = -wallet_paid
             driver_wallet_delta = float(wallet_paid - commission_amount)
@@ -348,6 +364,40 @@ class CaramRide(models.Model):
         else:
             raise UserError(_("Invalid payment_mode"))
 
+        # Commission and fines are charged in every mode
+        self._caram_plan_withdraw(
+            plan,
+            driver_card,
+            self.driver_id,
+            commission_amount + driver_penalty_amount,
+            commission_amount,
+            driver_penalty_amount,
+            commission_description,
+        )
+        if rider_penalty_amount > 0:
+            self._caram_plan_withdraw(
+                plan,
+                rider_card,
+                self.rider_id,
+                rider_penalty_amount,
+                0.0,
+                rider_penalty_amount,
+                f"Ride penalty {self.ride_id} (rider)",
+            )
+        self._caram_apply_posting_plan(plan)
+
+        self.write({
+            "state": "paid",
+            "paid_at": fields.Datetime.now(),
+            "payment_mode": PAYMENT_MODE_MAP.get(payment_mode),
+        })
+        self.env["caram.driver.earnings"].sudo()._caram_add_ride(
+            self,
+            wallet_paid if payment_mode in ("wallet_paid", "wallet_cash") else 0.0,
+            commission_amount,
+            driver_penalty_amount,
+        )
+
         response = {
             "status": "success",
             "ride_id": self.ride_id,
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class CaramRideArchive(models.Model):
+    _name = "caram.ride.archive"
+    _description = "CarAm Archived Ride"
+    _order = "paid_at desc, id desc"
+    _rec_name = "ride_id"
+
+    _sql_constraints = [
+        ("ride_id_company_uniq", "unique(ride_id, company_id)", "Ride ID must be unique per company."),
+    ]
+
+    ride_id = fields.Char(required=True, readonly=True)
+    company_id = fields.Many2one("res.company", required=True, readonly=True)
+    currency_id = fields.Many2one("res.currency", readonly=True)
+    rider_id = fields.Many2one("res.partner", string="Rider", readonly=True)
+    driver_id = fields.Many2one("res.partner", string="Driver", readonly=True)
+    fare_amount = fields.Monetary(readonly=True)
+    wallet_paid = fields.Monetary(readonly=True)
+    cash_paid = fields.Monetary(readonly=True)
+    commission_amount = fields.Monetary(readonly=True)
+    payment_mode = fields.Selection(
+        [
+            ("cash", "Cash"),
+            ("wallet", "Wallet"),
+            ("mixed", "Mixed"),
+        ],
+        readonly=True,
+    )
+    paid_at = fields.Datetime(readonly=True)
+
+    @api.model
+    def _caram_archive_rides(self, cutoff, limit):
+        """Move up to `limit` rides paid before `cutoff` from caram.ride to the archive.
+
+        Rides whose deferred accounting is not done yet stay in caram.ride, so the job queue
+        keeps its ride. Returns the number of archived rides.
+        """
+        self.env["caram.ride"].flush_model()
+        self.env.cr.execute(
+            """
+            WITH moved AS (
+                DELETE FROM caram_ride
+                 WHERE id IN (
+                        SELECT r.id
+                          FROM caram_ride r
+                         WHERE r.state = 'paid'
+                           AND r.paid_at < %(cutoff)s
+                           AND NOT EXISTS (
+                                SELECT 1
+                                  FROM caram_accounting_job j
+                                 WHERE j.ride_id = r.id AND j.state != 'done'
+                               )
+                      ORDER BY r.id
+                         LIMIT %(limit)s
+                           FOR UPDATE SKIP LOCKED
+                       )
+             RETURNING *
+            )
+            INSERT INTO caram_ride_archive
+                        (ride_id, company_id, currency_id, rider_id, driver_id, fare_amount, wallet_paid,
+                         cash_paid, commission_amount, payment_mode, paid_at,
+                         create_uid, create_date, write_uid, write_date)
+                 SELECT ride_id, company_id, currency_id, rider_id, driver_id, fare_amount, wallet_paid,
+                        cash_paid, commission_amount, payment_mode, paid_at,
+                        %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+                   FROM moved
+            """,
+            {"cutoff": cutoff, "limit": limit, "uid": self.env.uid},
+        )
+        count = self.env.cr.rowcount
+        self.env["caram.ride"].invalidate_model()
+        self.env["caram.accounting.job"].invalidate_model()
+        return count
+
+    @api.model
+    def _cron_caram_archive_rides(self, batch_size=5000):
+        """Archive the rides paid more than `caram.ride.archive_days` days ago (default 180)."""
+        days = int(self.env["ir.config_parameter"].sudo().get_param("caram.ride.archive_days", 180))
+        if days <= 0:
+            return 0
+        cutoff = fields.Datetime.now() - timedelta(days=days)
+        total = 0
+        while True:
+            count = self._caram_archive_rides(cutoff, batch_size)
+            self.env.cr.commit()
+            total += count
+            if count < batch_size:
+                break
+        _logger.info("CarAm: archived %s ride(s) paid before %s", total, cutoff)
+        return total
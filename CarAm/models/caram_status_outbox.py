@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+from odoo.tools import str2bool
+import logging
+_logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+RETRY_DELAY_MINUTES = 1
+
+
+class CaramStatusOutbox(models.Model):
+    _name = "caram.status.outbox"
+    _description = "CarAm Transaction Status Outbox"
+    _order = "id desc"
+    _rec_name = "caram_transaction_id"
+
+    payment_id = fields.Many2one("account.payment", required=True, index=True, readonly=True, ondelete="cascade")
+    company_id = fields.Many2one(related="payment_id.company_id", readonly=True)
+    caram_transaction_id = fields.Char("Transaction ID", required=True, readonly=True)
+    status = fields.Selection([("confirm", "Confirm"), ("decline", "Decline")], required=True, readonly=True)
+    state = fields.Selection(
+        [("pending", "Pending"), ("sent", "Sent"), ("dead", "Failed")],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    attempts = fields.Integer(readonly=True)
+    next_attempt_at = fields.Datetime(readonly=True, index=True, default=fields.Datetime.now)
+    sent_at = fields.Datetime(readonly=True)
+    last_error = fields.Text(readonly=True)
+
+    @api.model
+    def _caram_enqueue(self, payments, status):
+        """Queue `status` for these payments in the current transaction; delivery happens after commit."""
+        payments = payments.filtered("caram_transaction_id")
+        if not payments:
+            return self
+        messages = self.sudo().create([
+            {
+                "payment_id": payment.id,
+                "caram_transaction_id": payment.caram_transaction_id,
+                "status": status,
+            }
+            for payment in payments
+        ])
+        payments.sudo().write({"caram_status_synced": False})
+        self.env.ref("CarAm.ir_cron_caram_deliver_status")._trigger()
+        return messages
+
+    @api.model
+    def _caram_fetch_due(self, batch_size):
+        """Lock the next due messages; a message waits for the older ones of its payment."""
+        self.env.cr.execute(
+            """
+            SELECT o.id
+              FROM caram_status_outbox o
+             WHERE o.state = 'pending'
+               AND o.next_attempt_at <= now() AT TIME ZONE 'UTC'
+               AND NOT EXISTS (
+                    SELECT 1
+                      FROM caram_status_outbox prev
+                     WHERE prev.payment_id = o.payment_id
+                       AND prev.state = 'pending'
+                       AND prev.id < o.id
+                   )
+          ORDER BY o.id
+             LIMIT %s
+               FOR UPDATE SKIP LOCKED
+            """,
+            [batch_size],
+        )
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _caram_deliver(self):
+        """Deliver these messages and record each result.
+
+        With `caram.api.bulk_status` enabled, each status is sent for the whole batch in one
+        request to the bulk endpoint; otherwise one request is made per message.
+        """
+        bulk = str2bool(self.env["ir.config_parameter"].sudo().get_param("caram.api.bulk_status", "False"))
+        if bulk:
+            for status in set(self.mapped("status")):
+                messages = self.filtered(lambda m: m.status == status)
+                try:
+                    errors = messages.payment_id._caram_deliver_status_bulk(status)
+                except Exception as e:
+                    errors = dict.fromkeys(messages.mapped("caram_transaction_id"), str(e))
+                for message in messages:
+                    message._caram_record_result(errors.get(message.caram_transaction_id, "No result returned by CarAm"))
+        else:
+            for message in self:
+                try:
+                    message.payment_id._caram_deliver_status(message.status)
+                except Exception as e:
+                    message._caram_record_result(str(e))
+                else:
+                    message._caram_record_result(False)
+        self._caram_update_synced()
+
+    def _caram_record_result(self, error):
+        self.ensure_one()
+        if error:
+            self._caram_mark_failed(error)
+        else:
+            self.write({"state": "sent", "sent_at": fields.Datetime.now(), "attempts": self.attempts + 1, "last_error": False})
+
+    def _caram_mark_failed(self, error):
+        self.ensure_one()
+        attempts = self.attempts + 1
+        _logger.warning("CarAm: status sync of %s failed (attempt %s): %s", self.caram_transaction_id, attempts, error)
+        vals = {"attempts": attempts, "last_error": error}
+        if attempts >= MAX_ATTEMPTS:
+            vals["state"] = "dead"
+        else:
+            vals["next_attempt_at"] = fields.Datetime.now() + timedelta(minutes=RETRY_DELAY_MINUTES * 2 ** (attempts - 1))
+        self.write(vals)
+
+    def _caram_update_synced(self):
+        """A payment is synced once none of its messages is left to deliver."""
+        payments = self.payment_id
+        unsynced = self.search([("payment_id", "in", payments.ids), ("state", "!=", "sent")]).payment_id
+        (payments - unsynced).write({"caram_status_synced": True})
+
+    @api.model
+    def _cron_caram_deliver_status(self, batch_size=50, limit=1000):
+        """Deliver the pending status changes in batches, committing after each batch."""
+        processed = 0
+        while processed < limit:
+            messages = self._caram_fetch_due(batch_size)
+            if not messages:
+                break
+            messages._caram_deliver()
+            self.env.cr.commit()
+            processed += len(messages)
+        return processed
+
+    def action_retry(self):
+        self.filtered(lambda m: m.state == "dead").write({
+            "state": "pending",
+            "attempts": 0,
+            "next_attempt_at": fields.Datetime.now(),
+        })
+        self.env.ref("CarAm.ir_cron_caram_deliver_status")._trigger()
+        return True
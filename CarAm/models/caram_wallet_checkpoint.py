@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from odoo import api, fields, models
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class CaramWalletCheckpoint(models.Model):
+    _name = "caram.wallet.checkpoint"
+    _description = "CarAm Wallet Balance Checkpoint"
+    _order = "date desc, id desc"
+    _rec_name = "card_id"
+
+    _sql_constraints = [
+        ("card_date_uniq", "unique(card_id, date)", "Only one checkpoint per wallet and date is allowed."),
+    ]
+
+    card_id = fields.Many2one("loyalty.card", string="Wallet", required=True, index=True, ondelete="cascade", readonly=True)
+    partner_id = fields.Many2one(related="card_id.partner_id", readonly=True)
+    company_id = fields.Many2one(related="card_id.company_id", store=True, readonly=True)
+    date = fields.Date(required=True, readonly=True, help="Closing date: the balance includes everything posted up to the end of this day (UTC).")
+    balance = fields.Float(readonly=True)
+
+    @api.model
+    def _caram_create_checkpoints(self, date):
+        """Write the closing balance at `date` for every wallet that moved since its last checkpoint.
+
+        Each balance is the previous checkpoint plus the posted delta since it, so the job only
+        reads the history of the closed period. Wallets without activity keep their older
+        checkpoint, which is still valid for as-of queries.
+        """
+        self.env["loyalty.history"].flush_model(["card_id", "status", "issued", "used", "caram_posted_at"])
+        self.env.cr.execute(
+            """
+            INSERT INTO caram_wallet_checkpoint
+                        (card_id, company_id, date, balance, create_uid, create_date, write_uid, write_date)
+                 SELECT card.id, card.company_id, %(date)s,
+                        COALESCE(prev.balance, 0.0) + delta.amount,
+                        %(uid)s, now() AT TIME ZONE 'UTC', %(uid)s, now() AT TIME ZONE 'UTC'
+                   FROM loyalty_card card
+              LEFT JOIN LATERAL (
+                        SELECT cp.date, cp.balance
+                          FROM caram_wallet_checkpoint cp
+                         WHERE cp.card_id = card.id AND cp.date < %(date)s
+                      ORDER BY cp.date DESC
+                         LIMIT 1
+                        ) prev ON TRUE
+                   JOIN LATERAL (
+                        SELECT SUM(COALESCE(h.issued, 0.0) - COALESCE(h.used, 0.0)) AS amount
+                          FROM loyalty_history h
+                         WHERE h.card_id = card.id
+                           AND h.status = 'posted'
+                           AND h.caram_posted_at >= COALESCE(prev.date + 1, '-infinity'::date)
+                           AND h.caram_posted_at < %(date)s::date + 1
+                        ) delta ON delta.amount IS NOT NULL
+            ON CONFLICT (card_id, date) DO UPDATE SET balance = EXCLUDED.balance,
+                                                      write_uid = EXCLUDED.write_uid,
+                                                      write_date = EXCLUDED.write_date
+            """,
+            {"date": date, "uid": self.env.uid},
+        )
+        count = self.env.cr.rowcount
+        self.invalidate_model()
+        _logger.info("CarAm: wrote %s wallet checkpoint(s) for %s", count, date)
+        return count
+
+    @api.model
+    def _caram_invalidate_checkpoints(self, dates_by_card):
+        """Delete the checkpoints of {card_id: date} closing on or after `date`.
+
+        Called when a posted movement of that day is edited, cancelled or removed: the
+        checkpoints no longer match the history, and as-of balances fall back on the
+        previous checkpoint plus the history until the next closing rewrites them.
+        """
+        self.flush_model()
+        self.env.cr.execute(
+            """
+            DELETE FROM caram_wallet_checkpoint cp
+                  USING unnest(%s::int[], %s::date[]) AS stale(card_id, date)
+                  WHERE cp.card_id = stale.card_id AND cp.date >= stale.date
+            """,
+            [list(dates_by_card), list(dates_by_card.values())],
+        )
+        if self.env.cr.rowcount:
+            _logger.info("CarAm: dropped %s wallet checkpoint(s) after a change of posted history", self.env.cr.rowcount)
+        self.invalidate_model()
+
+    @api.model
+    def _cron_caram_wallet_checkpoints(self):
+        """Monthly cron: close the previous month (UTC, like the checkpoint boundaries)."""
+        closing_date = fields.Datetime.now().date().replace(day=1) - timedelta(days=1)
+        return self._caram_create_checkpoints(closing_date)
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
-from odoo import models, fields
+from collections import defaultdict
+from datetime import date
+
+from odoo import api, models, fields
+from odoo.tools.sql import column_exists, create_index
 
 class LoyaltyHistory(models.Model):
     _inherit = "loyalty.history"
 
+    card_id = fields.Many2one(index=True)
     deposit_method = fields.Selection([
         ('direct', 'Direct'),
         ('bank_transfer', 'Bank Transfer')
@@ -12,10 +17,147 @@ class LoyaltyHistory(models.Model):
     bank = fields.Char(string="Bank")
     status = fields.Selection([
         ('draft', 'Draft'),
-        ('posted', 'Posted')
+        ('posted', 'Posted'),
+        ('cancel', 'Cancelled'),
     ], string="Status", default='draft')
     
     account_number = fields.Char(
         string='Account Number',
         help='Customer bank account number'
-    )
\ No newline at end of file
+    )
+    caram_posted_at = fields.Datetime(
+        string="Posted On",
+        readonly=True,
+        copy=False,
+        help="When this row last became posted; used for as-of-date wallet balances.",
+    )
+    caram_payment_id = fields.Many2one(
+        "account.payment",
+        string="Payment",
+        index="btree_not_null",
+        ondelete="set null",
+        readonly=True,
+        copy=False,
+        help="Typed link kept in sync with order_model/order_id when they point to a payment.",
+    )
+    caram_move_id = fields.Many2one(
+        "account.move",
+        string="Journal Entry",
+        index="btree_not_null",
+        ondelete="set null",
+        readonly=True,
+        copy=False,
+        help="Typed link kept in sync with order_model/order_id when they point to a journal entry.",
+    )
+
+    def _auto_init(self):
+        new_posted_at = not column_exists(self.env.cr, self._table, "caram_posted_at")
+        new_links = not column_exists(self.env.cr, self._table, "caram_payment_id")
+        res = super()._auto_init()
+        if new_posted_at and column_exists(self.env.cr, self._table, "status"):
+            self.env.cr.execute(
+                "UPDATE loyalty_history SET caram_posted_at = create_date WHERE status = 'posted'"
+            )
+        if new_links:
+            # Backfill the typed links from the generic order_model/order_id reference
+            self.env.cr.execute(
+                """
+                UPDATE loyalty_history h
+                   SET caram_payment_id = h.order_id
+                  FROM account_payment p
+                 WHERE h.order_model = 'account.payment' AND p.id = h.order_id
+                """
+            )
+            self.env.cr.execute(
+                """
+                UPDATE loyalty_history h
+                   SET caram_move_id = h.order_id
+                  FROM account_move m
+                 WHERE h.order_model = 'account.move' AND m.id = h.order_id
+                """
+            )
+        return res
+
+    def init(self):
+        super().init()
+        create_index(
+            self.env.cr,
+            "loyalty_history_caram_card_posted_at_idx",
+            self._table,
+            ["card_id", "caram_posted_at"],
+            where="status = 'posted'",
+        )
+
+    @api.model
+    def _caram_document_link_vals(self, order_model, order_id):
+        """Return the typed document links matching an order_model/order_id reference."""
+        return {
+            "caram_payment_id": order_id if order_model == "account.payment" and order_id else False,
+            "caram_move_id": order_id if order_model == "account.move" and order_id else False,
+        }
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        now = fields.Datetime.now()
+        for vals in vals_list:
+            if vals.get("status") == "posted" and not vals.get("caram_posted_at"):
+                vals["caram_posted_at"] = now
+            if "order_model" in vals and not {"caram_payment_id", "caram_move_id"}.intersection(vals):
+                vals.update(self._caram_document_link_vals(vals["order_model"], vals.get("order_id")))
+        histories = super().create(vals_list)
+        histories._caram_update_posted_balance()
+        return histories
+
+    def write(self, vals):
+        if {"order_model", "order_id"}.intersection(vals) and not {"caram_payment_id", "caram_move_id"}.intersection(vals):
+            if "order_model" in vals and "order_id" in vals:
+                vals = dict(vals, **self._caram_document_link_vals(vals["order_model"], vals["order_id"]))
+            else:
+                res = True
+                for history in self:
+                    res &= history.write(dict(
+                        vals,
+                        **self._caram_document_link_vals(
+                            vals.get("order_model", history.order_model),
+                            vals.get("order_id", history.order_id),
+                        ),
+                    ))
+                return res
+        if not {"card_id", "status", "issued", "used"}.intersection(vals):
+            return super().write(vals)
+        if vals.get("status") == "posted" and "caram_posted_at" not in vals:
+            newly_posted = self.filtered(lambda h: h.status != "posted")
+            if newly_posted and newly_posted != self:
+                (self - newly_posted).write(vals)
+                return newly_posted.write(dict(vals, caram_posted_at=fields.Datetime.now()))
+            if newly_posted:
+                vals = dict(vals, caram_posted_at=fields.Datetime.now())
+        # Take the old posted amounts out of the card balance, then add the new ones back.
+        self._caram_update_posted_balance(sign=-1)
+        res = super().write(vals)
+        self._caram_update_posted_balance()
+        return res
+
+    def unlink(self):
+        self._caram_update_posted_balance(sign=-1)
+        return super().unlink()
+
+    def _caram_update_posted_balance(self, sign=1):
+        """Apply the posted amounts of these rows to `loyalty.card.caram_posted_balance`.
+
+        Rows posted before today (UTC) may be covered by wallet checkpoints, which are
+        dropped from that day on so as-of balances are recomputed from the history.
+        """
+        deltas = defaultdict(float)
+        stale_checkpoints = {}
+        today = fields.Datetime.now().date()
+        for history in self:
+            if history.status == "posted" and history.card_id:
+                card_id = history.card_id.id
+                deltas[card_id] += sign * ((history.issued or 0.0) - (history.used or 0.0))
+                posted_on = history.caram_posted_at.date() if history.caram_posted_at else date.min
+                if posted_on < today:
+                    stale_checkpoints[card_id] = min(posted_on, stale_checkpoints.get(card_id, posted_on))
+        self.env["loyalty.card"]._caram_apply_balance_deltas(deltas)
+        if stale_checkpoints:
+            self.env["caram.wallet.checkpoint"]._caram_invalidate_checkpoints(stale_checkpoints)
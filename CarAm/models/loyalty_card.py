@@ -1,12 +1,89 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, _, fields
+from odoo import api, models, _, fields
 from odoo.exceptions import UserError
+from odoo.tools import float_compare, str2bool
+from odoo.tools.sql import column_exists
+import logging
+
+_logger = logging.getLogger(__name__)
 
 
 class LoyaltyCard(models.Model):
     _inherit = "loyalty.card"
 
+    caram_posted_balance = fields.Float(
+        string="Posted Balance",
+        readonly=True,
+        copy=False,
+        help="Running sum(issued) - sum(used) of the posted wallet history, "
+             "maintained in the same transaction as every loyalty.history change.",
+    )
+
+    def _auto_init(self):
+        new_column = not column_exists(self.env.cr, self._table, "caram_posted_balance")
+        res = super()._auto_init()
+        # Seed the running balance once; afterwards loyalty.history keeps it up to date.
+        if new_column and column_exists(self.env.cr, "loyalty_history", "status"):
+            self.env.cr.execute(
+                """
+                UPDATE loyalty_card AS card
+                   SET caram_posted_balance = agg.balance
+                  FROM (
+                        SELECT card_id, SUM(COALESCE(issued, 0.0) - COALESCE(used, 0.0)) AS balance
+                          FROM loyalty_history
+                         WHERE status = 'posted'
+                      GROUP BY card_id
+                       ) AS agg
+                 WHERE card.id = agg.card_id
+                """
+            )
+        return res
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        cards = super().create(vals_list)
+        cards._caram_link_partner_wallets()
+        return cards
+
+    def write(self, vals):
+        if "partner_id" not in vals:
+            return super().write(vals)
+        previous_partners = self.partner_id
+        res = super().write(vals)
+        # Partners whose wallet now belongs to someone else fall back on their other e-Wallet card
+        stale = previous_partners.filtered(
+            lambda partner: partner.caram_wallet_card_id in self and partner.caram_wallet_card_id.partner_id != partner
+        )
+        if stale:
+            stale.sudo().write({"caram_wallet_card_id": False})
+            self.search([
+                ("partner_id", "in", stale.ids),
+                ("program_id.program_type", "=", "ewallet"),
+            ], order="id")._caram_link_partner_wallets()
+        self._caram_link_partner_wallets()
+        return res
+
+    def _caram_link_partner_wallets(self):
+        """Make these e-Wallet cards the wallet of their partners that have none yet (one UPDATE)."""
+        links = {}
+        for card in self:
+            if card.partner_id and card.program_id.program_type == "ewallet" and card.partner_id.id not in links:
+                links[card.partner_id.id] = card.id
+        if not links:
+            return
+        Partner = self.env["res.partner"]
+        Partner.flush_model(["caram_wallet_card_id"])
+        self.env.cr.execute(
+            """
+            UPDATE res_partner AS p
+               SET caram_wallet_card_id = link.card_id
+              FROM unnest(%s::int[], %s::int[]) AS link(partner_id, card_id)
+             WHERE p.id = link.partner_id AND p.caram_wallet_card_id IS NULL
+            """,
+            [list(links), list(links.values())],
+        )
+        Partner.browse(list(links)).invalidate_recordset(["caram_wallet_card_id"])
 
     def _create_invoice_from_lines(self, partner_id, invoice_line_vals_list):
         """Create & post an out_invoice for partner with provided invoice lines."""
@@ -34,13 +111,23 @@ class LoyaltyCard(models.Model):
         invoice.action_post()
         return invoice
 
+    def _caram_create_withdraw_invoice(self, partner, commission_amount, fine_amount):
+        """Create & post the commission/fine invoice of a wallet withdrawal."""
+        self.ensure_one()
+        invoice_lines = []
+        if commission_amount >= 0:
+            invoice_lines.append(self._prepare_commission_invoice_line_vals(commission_amount))
+        if fine_amount > 0:
+            invoice_lines.append(self._prepare_fine_invoice_line_vals(fine_amount))
+        return self._create_invoice_from_lines(partner, invoice_lines)
+
     def _prepare_commission_invoice_line_vals(self, amount):
         self.ensure_one()
-        commission_product = self.company_id.caram_commission_product_id
-        if not commission_product:
+        commission_product_id = self.company_id._caram_get_config()["commission_product_id"]
+        if not commission_product_id:
             raise UserError(_("Please set commission product in the settings !"))
         return {
-            "product_id": commission_product.id,
+            "product_id": commission_product_id,
             "name": _("Ride Commission"),
             "quantity": 1,
             "price_unit": amount,
@@ -48,11 +135,11 @@ class LoyaltyCard(models.Model):
 
     def _prepare_fine_invoice_line_vals(self, amount):
         self.ensure_one()
-        fine_product = self.company_id.caram_fine_product_id
-        if not fine_product:
+        fine_product_id = self.company_id._caram_get_config()["fine_product_id"]
+        if not fine_product_id:
             raise UserError(_("Please set fine product in the settings !"))
         return {
-            "product_id": fine_product.id,
+            "product_id": fine_product_id,
             "name": _("Ride Fine"),
             "quantity": 1,
             "price_unit": amount,
@@ -60,23 +147,8 @@ class LoyaltyCard(models.Model):
 
     def create_points_credit_note(self, env, company_id, partner, amount):
         """Create & post a customer credit note to represent the welcome coupon."""
-        points_product = env['product.product'].sudo().with_company(company_id).search(
-            [('is_points', '=', True)],
-            limit=1,
-        )
-        if not points_product:
-            return False
-
-        expense_account = (
-            points_product.property_account_expense_id
-            or points_product.categ_id.property_account_expense_id
-        )
-        if not expense_account:
-            expense_account = env['account.account'].sudo().with_company(company_id).search(
-                [('company_id', '=', company_id), ('account_type', 'in', ('expense'))],
-                limit=1,
-            )
-        if not expense_account:
+        config = env['res.company'].sudo().browse(company_id)._caram_get_config()
+        if not config['points_product_id'] or not config['points_expense_account_id']:
             return False
 
         credit_note = env['account.move'].sudo().with_company(company_id).create({
@@ -85,8 +157,8 @@ class LoyaltyCard(models.Model):
             'move_type': 'out_refund',
             'invoice_date': fields.Date.today(),
             'invoice_line_ids': [(0, 0, {
-                'product_id': points_product.id,
-                'account_id': expense_account.id,
+                'product_id': config['points_product_id'],
+                'account_id': config['points_expense_account_id'],
                 'name': 'Loyality program - points Credit',
                 'quantity': 1,
                 'price_unit': amount,
@@ -121,13 +193,8 @@ class LoyaltyCard(models.Model):
         if not hasattr(partner, "id"):
             return None, _("Invalid partner value for payment.")
 
-        journal = self.env["account.journal"].sudo().search(
-            [
-                ("journal_sub_type", "=", payment_method_type),
-                ("company_id", "=", self.company_id.id),
-            ],
-            limit=1,
-        )
+        journal_id = self.company_id._caram_get_config()["payment_journal_ids"].get(payment_method_type)
+        journal = self.env["account.journal"].sudo().browse(journal_id)
         if not journal:
             return None, _("No journal found for %s") % (payment_method_type,)
 
@@ -158,140 +225,256 @@ class LoyaltyCard(models.Model):
 
     def _get_general_journal(self):
         self.ensure_one()
-        journal = self.company_id.caram_wallet_journal_id
-        if journal:
-            return journal.id
-        journal = self.env["account.journal"].sudo().with_company(self.company_id.id).search(
-            [("company_id", "=", self.company_id.id), ("type", "=", "sale")], limit=1
-        )
-        if not journal:
+        journal_id = self.company_id._caram_get_config()["wallet_journal_id"]
+        if not journal_id:
             raise UserError(_("No general journal found to post CarAm ride accounting entries."))
-        return journal.id
+        return journal_id
+
+    def caram_get_posted_balance(self, verify=False):
+        """Return wallet balance based on posted loyalty history: sum(issued) - sum(used).
 
-    def caram_get_posted_balance(self):
-        """Return wallet balance based on posted loyalty history: sum(issued) - sum(used)."""
+        Reads the running balance; with `verify=True` the history is re-aggregated in SQL
+        first and the running balance repaired if it had drifted.
+        """
         self.ensure_one()
-        posted_history = self.env["loyalty.history"].sudo().search(
-            [("card_id", "=", self.id), ("status", "=", "posted")]
+        if verify:
+            self._caram_recompute_posted_balance()
+        return self.caram_posted_balance
+
+    def _caram_lock(self):
+        """Lock these wallet rows until the end of the transaction.
+
+        Rows are always locked in id order so two payments touching the same pair of wallets
+        cannot deadlock; a concurrent payment on the same wallet waits here instead of
+        overwriting the balance. Locking an already locked row is a no-op.
+
+        Odoo transactions run at REPEATABLE READ: once the payment holding the lock commits,
+        the waiting one fails with a serialization error and relies on the request dispatcher
+        replaying it with a fresh snapshot (see `CaramApiController._concurrency_failure`).
+        """
+        if not self:
+            return self
+        self.flush_model(["points", "caram_posted_balance"])
+        self.env.cr.execute(
+            "SELECT id FROM loyalty_card WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE",
+            [self.ids],
         )
-        total_issued = sum(posted_history.mapped("issued") or [0.0])
-        total_used = sum(posted_history.mapped("used") or [0.0])
-      
-        return total_issued - total_used
+        self.invalidate_recordset(["points", "caram_posted_balance"])
+        return self
 
-    def caram_withdraw(
-        self,
-        amount,
-        commission_amount=0.0,
-        fine_amount=0.0,
-        *,
-        description="",
-        status="posted",
-        driver=None,
-        should_create_invoice=True,
-        order_model=None,
-        order_id=None,
-    ): 
+    def caram_get_available_balance(self):
+        """Return the posted balance minus the withdrawals still waiting to be posted."""
         self.ensure_one()
-        amount = float(amount or 0.0)
-        commission_amount = float(commission_amount or 0.0)
-        fine_amount = float(fine_amount or 0.0)
-        #if amount <= 0:
-            #raise UserError(_("amount must be greater than 0"))
+        return self._caram_get_available_balances()[self.id]
 
-        balance_before = self.caram_get_posted_balance()
-        
-        should_invoice = should_create_invoice and (commission_amount >= 0 or fine_amount > 0)
-        if should_invoice:
-            invoice_lines = []
-            if commission_amount >= 0:
-                invoice_lines.append(self._prepare_commission_invoice_line_vals(commission_amount))
-            if fine_amount > 0:
-                invoice_lines.append(self._prepare_fine_invoice_line_vals(fine_amount))
-            invoice = self._create_invoice_from_lines(driver, invoice_lines)
-        else:
-            invoice = None
-        tx = (
-            self.env["loyalty.history"]
-            .sudo()
-            .create(
-                {
-                    "card_id": self.id,
-                    "description": description or "",
-                    "issued": -amount,
-                    "used": 0.0,
-                    "status": status or "posted",
-                    "order_model": "account.move" if invoice else order_model,
-                    "order_id":invoice.id if invoice else order_id,
-                }
-            )
+    def _caram_get_available_balances(self):
+        """Return {card_id: available balance} of these cards with a single query."""
+        if not self:
+            return {}
+        self.env["loyalty.history"].flush_model(["card_id", "status", "issued", "used"])
+        self.env.cr.execute(
+            """
+            SELECT card_id, SUM(COALESCE(issued, 0.0) - COALESCE(used, 0.0))
+              FROM loyalty_history
+             WHERE card_id = ANY(%s) AND status = 'draft' AND COALESCE(issued, 0.0) - COALESCE(used, 0.0) < 0
+          GROUP BY card_id
+            """,
+            [self.ids],
         )
-        
-        balance_after = (
-            self.caram_get_posted_balance() if (status or "posted") == "posted" else (balance_before - amount)
-        )
-        self.sudo().write({"points": balance_after})
-        return tx
+        pending = dict(self.env.cr.fetchall())
+        return {card.id: card.caram_posted_balance + pending.get(card.id, 0.0) for card in self}
 
-    def caram_addwallet(
-        self,
-        amount,
-        *,
-        description="",
-        status="posted",
-        driver=None,
-        should_create_payment=True,
-        order_model=None,
-        order_id=None,
-    ):
+    def caram_check_available_balance(self, amount):
+        """Lock the wallet and raise if `amount` cannot be debited from it."""
         self.ensure_one()
-        amount = float(amount or 0.0)
-        #if amount <= 0:
-            #raise UserError(_("amount must be greater than 0"))
-        if should_create_payment:
-            payment, error = self._create_payment(
-                driver,
-                amount,
-                "cash",
-                description or "",
-                should_post=True,
-                transaction_id=None,
-                image_url=None,
-                bank=None,
-                account_number=None,
+        self._caram_lock()
+        rounding = self.currency_id.rounding or 0.01
+        if float_compare(float(amount or 0.0), self.caram_get_available_balance(), precision_rounding=rounding) > 0:
+            raise UserError(_("Insufficient wallet balance"))
+        return True
+
+    @api.model
+    def _caram_apply_balance_deltas(self, deltas):
+        """Add {card_id: amount} to the running posted balances with a single UPDATE."""
+        deltas = {card_id: amount for card_id, amount in deltas.items() if card_id and amount}
+        if not deltas:
+            return
+        self.flush_model(["caram_posted_balance"])
+        self.env.cr.execute(
+            """
+            UPDATE loyalty_card AS card
+               SET caram_posted_balance = COALESCE(card.caram_posted_balance, 0.0) + delta.amount
+              FROM unnest(%s::int[], %s::float8[]) AS delta(card_id, amount)
+             WHERE card.id = delta.card_id
+            """,
+            [list(deltas), list(deltas.values())],
+        )
+        self.browse(list(deltas)).invalidate_recordset(["caram_posted_balance"])
+
+    def _caram_compute_posted_balances(self):
+        """Aggregate the posted history of these cards in SQL.
+
+        Returns: {card_id: sum(issued) - sum(used)}, with 0.0 for cards without posted history.
+        """
+        if not self:
+            return {}
+        self.env["loyalty.history"].flush_model(["card_id", "status", "issued", "used"])
+        self.env.cr.execute(
+            """
+            SELECT card.id, COALESCE(SUM(COALESCE(h.issued, 0.0) - COALESCE(h.used, 0.0)), 0.0)
+              FROM loyalty_card card
+         LEFT JOIN loyalty_history h ON h.card_id = card.id AND h.status = 'posted'
+             WHERE card.id = ANY(%s)
+          GROUP BY card.id
+            """,
+            [self.ids],
+        )
+        return dict(self.env.cr.fetchall())
+
+    def _caram_recompute_posted_balance(self):
+        """Fallback path: rebuild the running balance of these cards from the history.
+
+        Returns: {card_id: (stored_balance, recomputed_balance)} for the cards that had drifted.
+        """
+        balances = self._caram_compute_posted_balances()
+        drifted = {}
+        for card in self:
+            stored = card.caram_posted_balance or 0.0
+            if abs(stored - balances[card.id]) > 1e-6:
+                drifted[card.id] = (stored, balances[card.id])
+        if drifted:
+            self.flush_model(["caram_posted_balance"])
+            self.env.cr.execute(
+                """
+                UPDATE loyalty_card AS card
+                   SET caram_posted_balance = fixed.balance
+                  FROM unnest(%s::int[], %s::float8[]) AS fixed(card_id, balance)
+                 WHERE card.id = fixed.card_id
+                """,
+                [list(drifted), [new for _old, new in drifted.values()]],
             )
-            if error:
-                raise UserError(error)
-        else:
-            payment = None
-         
-        transaction_vals = {
-            "card_id": self.id,
-            "description": description or "",
-            "issued": amount,
-            "deposit_method": "direct",
-            "reference": "",
-            "bank": "",
-            "account_number": "",
-            "status": status or "posted",
-            
-        }
-            
-        if payment and hasattr(payment, "id"):
-            transaction_vals.update({
-                "order_model": "account.payment",
-                "order_id": payment.id,
-            })
+            self.browse(list(drifted)).invalidate_recordset(["caram_posted_balance"])
+            _logger.info("CarAm: recomputed posted balance of %s wallet(s)", len(drifted))
+        return drifted
+
+    @api.model
+    def _caram_check_wallet_drift(self, repair=False, batch_size=5000, auto_commit=False):
+        """Compare `points` and the running balance of every card with its history.
+
+        The running balance must match the posted history, and `points` the posted history
+        minus the withdrawals still reserved in draft. The drift is found with one grouped
+        aggregation over loyalty.history; when `repair` is set the drifted cards are locked and
+        rewritten in batches of `batch_size`, their balances being aggregated again inside the
+        UPDATE so a movement posted since the scan is not overwritten.
 
+        Returns: list of (card_id, points, caram_posted_balance, expected_points, expected_balance).
+        """
+        self.flush_model(["points", "caram_posted_balance"])
+        self.env["loyalty.history"].flush_model(["card_id", "status", "issued", "used"])
+        self.env.cr.execute(
+            f"""
+            SELECT card.id,
+                   COALESCE(card.points, 0.0),
+                   COALESCE(card.caram_posted_balance, 0.0),
+                   COALESCE(agg.balance, 0.0) + COALESCE(agg.reserved, 0.0),
+                   COALESCE(agg.balance, 0.0)
+              FROM loyalty_card card
+         LEFT JOIN ({self._caram_history_balances_query()}) agg ON agg.card_id = card.id
+             WHERE ABS(COALESCE(card.points, 0.0) - COALESCE(agg.balance, 0.0) - COALESCE(agg.reserved, 0.0)) > %(tolerance)s
+                OR ABS(COALESCE(card.caram_posted_balance, 0.0) - COALESCE(agg.balance, 0.0)) > %(tolerance)s
+          ORDER BY card.id
+            """,
+            {"tolerance": 1e-6, "card_ids": None},
+        )
+        drifts = self.env.cr.fetchall()
+        if drifts:
+            _logger.warning(
+                "CarAm: %s wallet(s) drifted from their history (total points drift %.2f), e.g. %s",
+                len(drifts),
+                sum(points - expected for _card_id, points, _running, expected, _balance in drifts),
+                drifts[:10],
+            )
         else:
-            transaction_vals.update({
-                "order_model": order_model if not order_model is None else "res.partner",
-                "order_id": order_id if not order_id is None else driver.id ,
-            })
+            _logger.info("CarAm: no wallet drift detected")
 
-        transaction = self.env['loyalty.history'].sudo().create(transaction_vals)
-        total_balance = self.caram_get_posted_balance()
-        # -------------------- Update Card Points --------------------
-        self.sudo().write({"points": total_balance})
+        if repair:
+            for start in range(0, len(drifts), batch_size):
+                cards = self.browse([row[0] for row in drifts[start:start + batch_size]])
+                cards._caram_lock()
+                self.env.cr.execute(
+                    f"""
+                    UPDATE loyalty_card AS card
+                       SET points = COALESCE(agg.balance, 0.0) + COALESCE(agg.reserved, 0.0),
+                           caram_posted_balance = COALESCE(agg.balance, 0.0)
+                      FROM unnest(%(card_ids)s::int[]) AS fixed(card_id)
+                 LEFT JOIN ({self._caram_history_balances_query()}) agg ON agg.card_id = fixed.card_id
+                     WHERE card.id = fixed.card_id
+                    """,
+                    {"card_ids": cards.ids},
+                )
+                cards.invalidate_recordset(["points", "caram_posted_balance"])
+                if auto_commit:
+                    self.env.cr.commit()
+            if drifts:
+                _logger.info("CarAm: repaired %s drifted wallet(s)", len(drifts))
+        return drifts
 
-        return transaction
\ No newline at end of file
+    @api.model
+    def _caram_history_balances_query(self):
+        """SQL giving, per card, the posted `balance` and the `reserved` (negative) draft withdrawals.
+
+        Restricted to the cards of the `card_ids` query parameter unless it is NULL.
+        """
+        return """
+            SELECT card_id,
+                   SUM(COALESCE(issued, 0.0) - COALESCE(used, 0.0)) FILTER (WHERE status = 'posted') AS balance,
+                   SUM(COALESCE(issued, 0.0) - COALESCE(used, 0.0)) FILTER (
+                       WHERE status = 'draft' AND COALESCE(issued, 0.0) - COALESCE(used, 0.0) < 0
+                   ) AS reserved
+              FROM loyalty_history
+             WHERE status IN ('posted', 'draft')
+               AND (%(card_ids)s::int[] IS NULL OR card_id = ANY(%(card_ids)s::int[]))
+          GROUP BY card_id
+        """
+
+    @api.model
+    def _cron_caram_check_wallet_drift(self):
+        """Daily cron: report wallet drift, and repair it when `caram.wallet_drift.auto_repair` is set."""
+        repair = self.env["ir.config_parameter"].sudo().get_param("caram.wallet_drift.auto_repair", "False")
+        self._caram_check_wallet_drift(repair=str2bool(repair, default=False), auto_commit=True)
+
+    def caram_get_balances_at(self, date):
+        """Return {card_id: posted balance at the end of `date` (UTC)} for these cards.
+
+        One query for all cards: the latest checkpoint on or before `date` plus the posted
+        history since that checkpoint.
+        """
+        if not self:
+            return {}
+        date = fields.Date.to_date(date)
+        self.env["loyalty.history"].flush_model(["card_id", "status", "issued", "used", "caram_posted_at"])
+        self.env["caram.wallet.checkpoint"].flush_model()
+        self.env.cr.execute(
+            """
+            SELECT card.id, COALESCE(cp.balance, 0.0) + COALESCE(delta.amount, 0.0)
+              FROM loyalty_card card
+         LEFT JOIN LATERAL (
+                   SELECT c.date, c.balance
+                     FROM caram_wallet_checkpoint c
+                    WHERE c.card_id = card.id AND c.date <= %(date)s
+                 ORDER BY c.date DESC
+                    LIMIT 1
+                   ) cp ON TRUE
+         LEFT JOIN LATERAL (
+                   SELECT SUM(COALESCE(h.issued, 0.0) - COALESCE(h.used, 0.0)) AS amount
+                     FROM loyalty_history h
+                    WHERE h.card_id = card.id
+                      AND h.status = 'posted'
+                      AND h.caram_posted_at >= COALESCE(cp.date + 1, '-infinity'::date)
+                      AND h.caram_posted_at < %(date)s::date + 1
+                   ) delta ON TRUE
+             WHERE card.id = ANY(%(ids)s)
+            """,
+            {"date": date, "ids": self.ids},
+        )
+        return dict(self.env.cr.fetchall())
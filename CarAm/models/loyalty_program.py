@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, models
+
+
+class LoyaltyProgram(models.Model):
+    _inherit = "loyalty.program"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        programs = super().create(vals_list)
+        if any(program.program_type == "ewallet" for program in programs):
+            self.env["res.company"]._caram_invalidate_config()
+        return programs
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"program_type", "company_id", "active"}.intersection(vals):
+            self.env["res.company"]._caram_invalidate_config()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self.env["res.company"]._caram_invalidate_config()
+        return res
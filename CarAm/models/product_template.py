@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields
+from odoo import api, models, fields
 
 
 class ProductTemplate(models.Model):
@@ -18,5 +18,15 @@ class ProductTemplate(models.Model):
         help="Marks this product as a points product (used by CarAm Loyality logic).",
     )
 
-
-
+    @api.model_create_multi
+    def create(self, vals_list):
+        templates = super().create(vals_list)
+        if any(vals.get("is_coupon") or vals.get("is_points") for vals in vals_list):
+            self.env["res.company"]._caram_invalidate_config()
+        return templates
+
+    def write(self, vals):
+        res = super().write(vals)
+        if {"is_coupon", "is_points", "active", "company_id", "categ_id", "property_account_expense_id"}.intersection(vals):
+            self.env["res.company"]._caram_invalidate_config()
+        return res
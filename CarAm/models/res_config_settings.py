@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields
+from odoo import api, models, fields, tools
+from odoo.tools import frozendict
 
 
 class ResCompany(models.Model):
@@ -71,6 +72,131 @@ class ResCompany(models.Model):
         help="Product used on fine/penalty invoices for CarAm rides.",
     )
 
+    caram_invoice_mode = fields.Selection(
+        [
+            ("per_ride", "Per Ride"),
+            ("periodic", "Periodic"),
+        ],
+        string="Commission Invoicing",
+        default="per_ride",
+        help="Per Ride: post one invoice for every commission/fine. "
+             "Periodic: accrue commissions and fines and issue one consolidated invoice per partner and period.",
+    )
+
+    caram_invoice_period = fields.Selection(
+        [
+            ("daily", "Daily"),
+            ("weekly", "Weekly"),
+        ],
+        string="Invoicing Period",
+        default="daily",
+        help="Period covered by the consolidated commission/fine invoices.",
+    )
+
+    caram_accounting_mode = fields.Selection(
+        [
+            ("sync", "Synchronous"),
+            ("deferred", "Deferred"),
+        ],
+        string="Ride Accounting",
+        default="sync",
+        help="Synchronous: ride payments create their invoices, payments and journal entries in the API request. "
+             "Deferred: the API request only writes the wallet transactions, the accounting documents are "
+             "created by a background job.",
+    )
+
+
+    def write(self, vals):
+        res = super().write(vals)
+        if any(fname.startswith("caram_") for fname in vals):
+            self.env.registry.clear_cache()
+        return res
+
+    @api.model
+    def _caram_invalidate_config(self):
+        """Drop the cached CarAm configuration of every company (all workers)."""
+        self.env.registry.clear_cache()
+
+    @tools.ormcache("self.id")
+    def _caram_get_config(self):
+        """Resolve and validate the CarAm configuration of this company once.
+
+        The result is cached per registry and only holds ids, so hot paths can browse the
+        records without running any configuration query. The cache is cleared whenever the
+        CarAm company fields, journals, products, loyalty programs or accounts change.
+        """
+        self.ensure_one()
+        company = self.sudo()
+        Journal = self.env["account.journal"].sudo().with_company(company.id)
+        Account = self.env["account.account"].sudo().with_company(company.id)
+        Product = self.env["product.product"].sudo().with_company(company.id)
+
+        wallet_journal = company.caram_wallet_journal_id or Journal.search(
+            [("company_id", "=", company.id), ("type", "=", "sale")], limit=1
+        )
+        general_journal = Journal.search([("company_id", "=", company.id), ("type", "=", "general")], limit=1)
+        subscription_journal = Journal.search([
+            ("company_id", "=", company.id),
+            ("type", "=", "sale"),
+            ("is_used_for_subscriptions", "=", True),
+        ], limit=1)
+        payment_journal_ids = {}
+        for journal in Journal.search([("company_id", "=", company.id), ("journal_sub_type", "!=", False)]):
+            payment_journal_ids.setdefault(journal.journal_sub_type, journal.id)
+
+        default_expense_account = Account.search([
+            *Account._check_company_domain(company),
+            ("account_type", "=", "expense"),
+        ], limit=1)
+
+        def product_and_expense_account(flag):
+            product = Product.search([*Product._check_company_domain(company), (flag, "=", True)], limit=1)
+            account = (
+                product.property_account_expense_id
+                or product.categ_id.property_account_expense_id
+                or default_expense_account
+            )
+            return product.id or False, account.id or False
+
+        points_product_id, points_expense_account_id = product_and_expense_account("is_points")
+        coupon_product_id, coupon_expense_account_id = product_and_expense_account("is_coupon")
+
+        program = self.env["loyalty.program"].sudo().search([
+            ("program_type", "=", "ewallet"),
+            ("company_id", "=", company.id),
+        ], limit=1)
+
+        account_errors = {}
+        for account in (
+            company.caram_bank_account_id
+            | company.caram_bouns_account_id
+            | company.caram_rider_wallets_account_id
+            | company.caram_driver_wallet_account_id
+        ):
+            if not account.exists():
+                account_errors[account.id] = "Account not found or invalid"
+            elif not account.company_ids or company.id not in account.company_ids.ids:
+                account_errors[account.id] = "Bank account company mismatch"
+
+        return frozendict({
+            "wallet_journal_id": wallet_journal.id or False,
+            "general_journal_id": general_journal.id or False,
+            "subscription_journal_id": subscription_journal.id or False,
+            "payment_journal_ids": frozendict(payment_journal_ids),
+            "points_product_id": points_product_id,
+            "points_expense_account_id": points_expense_account_id,
+            "coupon_product_id": coupon_product_id,
+            "coupon_expense_account_id": coupon_expense_account_id,
+            "ewallet_program_id": program.id or False,
+            "commission_product_id": company.caram_commission_product_id.id or False,
+            "fine_product_id": company.caram_fine_product_id.id or False,
+            "bank_account_id": company.caram_bank_account_id.id or False,
+            "bonus_account_id": company.caram_bouns_account_id.id or False,
+            "rider_wallet_account_id": company.caram_rider_wallets_account_id.id or False,
+            "driver_wallet_account_id": company.caram_driver_wallet_account_id.id or False,
+            "account_errors": frozendict(account_errors),
+        })
+
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
@@ -124,9 +250,37 @@ class ResConfigSettings(models.TransientModel):
         related="company_id.caram_fine_product_id",
         readonly=False,
     )
+
+    caram_invoice_mode = fields.Selection(
+        related="company_id.caram_invoice_mode",
+        readonly=False,
+    )
+
+    caram_invoice_period = fields.Selection(
+        related="company_id.caram_invoice_period",
+        readonly=False,
+    )
+
+    caram_accounting_mode = fields.Selection(
+        related="company_id.caram_accounting_mode",
+        readonly=False,
+    )
     
     caram_api_base_url = fields.Char(
         config_parameter='caram.api.base.url',
         default='https://staging.caram.app',
         help='Base URL for CarAm API (use staging.caram.app for testing, backend.caram.app for production)'
+    )
+
+    caram_api_bulk_status = fields.Boolean(
+        string="Bulk Status Sync",
+        config_parameter='caram.api.bulk_status',
+        help='Send the queued transaction status updates in one request per batch to the bulk endpoint'
+    )
+
+    caram_api_stream_attachments = fields.Boolean(
+        string="Stream Attachments",
+        config_parameter='caram.api.stream_attachments',
+        help='Upload proofs of transfer as a streamed multipart form (encrypted chunk by chunk) '
+             'instead of a base64 field of the JSON payload'
     )
\ No newline at end of file
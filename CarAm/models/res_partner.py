@@ -1,7 +1,34 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields, api
-from odoo.exceptions import ValidationError
+import re
+
+import psycopg2
+
+from odoo import models, fields, api, _
+from odoo.exceptions import UserError
+from odoo.tools.sql import column_exists, create_column, index_exists
+
+
+def normalize_mobile(mobile):
+    """Return a Saudi mobile number as digits with the 966 country code.
+
+    "+966 5x xxx xxxx", "00966 5x...", "9660 5x...", "05x..." and "5x..." all give "9665x...";
+    other numbers are returned as bare digits.
+    """
+    digits = re.sub(r"\D", "", mobile or "")
+    if digits.startswith("00"):
+        digits = digits[2:]
+    if digits.startswith("9660"):
+        digits = "966" + digits[4:]
+    elif re.fullmatch(r"05\d{8}", digits):
+        digits = "966" + digits[1:]
+    elif re.fullmatch(r"5\d{8}", digits):
+        digits = "966" + digits
+    return digits or False
+
+
+def normalize_email(email):
+    return (email or "").strip().lower() or False
 
 
 
@@ -24,21 +51,115 @@ class ResPartner(models.Model):
         ('driver', 'Driver'),
         ('rider', 'Rider'),
     ], string='Contact Type')
-    
- 
-    
-    @api.constrains('sub_id', 'company_id')
-    def _check_unique_sub_id(self):
-        """Ensure sub_id is unique per company"""
-        for record in self:
-            if record.sub_id and record.company_id:
-                existing = self.search([
-                    ('sub_id', '=', record.sub_id),
-                    ('company_id', '=', record.company_id.id),
-                    ('id', '!=', record.id)
-                ], limit=1)
-                if existing:
-                    raise ValidationError(
-                        f"A contact with Platform ID '{record.sub_id}' already exists in this company."
-                    )
 
+    caram_mobile_normalized = fields.Char(
+        string='Normalized Mobile',
+        compute='_compute_caram_normalized_contact',
+        store=True,
+        index='btree_not_null',
+        help='Mobile as digits with the 966 country code, used to match contacts from the API',
+    )
+    caram_email_normalized = fields.Char(
+        string='Normalized Email',
+        compute='_compute_caram_normalized_contact',
+        store=True,
+        index='btree_not_null',
+    )
+
+    caram_wallet_card_id = fields.Many2one(
+        'loyalty.card',
+        string='e-Wallet',
+        index='btree_not_null',
+        ondelete='set null',
+        readonly=True,
+        copy=False,
+        help='Wallet of the contact, set when its card is created, so API calls read it by id',
+    )
+
+    def _auto_init(self):
+        # Create and backfill the columns in SQL so the ORM does not recompute every partner
+        if not column_exists(self.env.cr, self._table, 'caram_mobile_normalized'):
+            create_column(self.env.cr, self._table, 'caram_mobile_normalized', 'varchar')
+            create_column(self.env.cr, self._table, 'caram_email_normalized', 'varchar')
+            self.env.cr.execute(
+                r"""
+                WITH digits AS (
+                    SELECT id, regexp_replace(regexp_replace(mobile, '\D', '', 'g'), '^00', '') AS n
+                      FROM res_partner
+                     WHERE mobile IS NOT NULL
+                )
+                UPDATE res_partner p
+                   SET caram_mobile_normalized = NULLIF(CASE
+                           WHEN d.n LIKE '9660%' THEN '966' || substr(d.n, 5)
+                           WHEN d.n ~ '^05\d{8}$' THEN '966' || substr(d.n, 2)
+                           WHEN d.n ~ '^5\d{8}$' THEN '966' || d.n
+                           ELSE d.n
+                       END, '')
+                  FROM digits d
+                 WHERE p.id = d.id
+                """
+            )
+            self.env.cr.execute(
+                """
+                UPDATE res_partner
+                   SET caram_email_normalized = NULLIF(lower(trim(email)), '')
+                 WHERE email IS NOT NULL
+                """
+            )
+        new_wallet_link = not column_exists(self.env.cr, self._table, 'caram_wallet_card_id')
+        res = super()._auto_init()
+        if new_wallet_link:
+            # One wallet per partner: its oldest e-Wallet program card
+            self.env.cr.execute(
+                """
+                UPDATE res_partner p
+                   SET caram_wallet_card_id = c.id
+                  FROM (
+                        SELECT DISTINCT ON (card.partner_id) card.partner_id, card.id
+                          FROM loyalty_card card
+                          JOIN loyalty_program program ON program.id = card.program_id
+                         WHERE card.partner_id IS NOT NULL
+                           AND program.program_type = 'ewallet'
+                      ORDER BY card.partner_id, card.id
+                       ) c
+                 WHERE p.id = c.partner_id
+                """
+            )
+        return res
+
+    @api.depends('mobile', 'email')
+    def _compute_caram_normalized_contact(self):
+        for partner in self:
+            partner.caram_mobile_normalized = normalize_mobile(partner.mobile)
+            partner.caram_email_normalized = normalize_email(partner.email)
+
+    def init(self):
+        super().init()
+        # sub_id is unique per company; enforced by the database instead of a search per record
+        if not index_exists(self.env.cr, "res_partner_sub_id_company_uniq"):
+            try:
+                with self.env.cr.savepoint(flush=False):
+                    self.env.cr.execute(
+                        """
+                        CREATE UNIQUE INDEX res_partner_sub_id_company_uniq
+                            ON res_partner (sub_id, company_id)
+                         WHERE sub_id IS NOT NULL
+                        """
+                    )
+            except psycopg2.errors.UniqueViolation as e:
+                # Nothing else enforces the uniqueness, so the update must not go on without it
+                self.env.cr.execute(
+                    """
+                    SELECT sub_id, company_id, array_agg(id ORDER BY id)
+                      FROM res_partner
+                     WHERE sub_id IS NOT NULL
+                  GROUP BY sub_id, company_id
+                    HAVING COUNT(*) > 1
+                     LIMIT 10
+                    """
+                )
+                raise UserError(_(
+                    "Cannot create the unique index on contacts (Platform ID, company): duplicate "
+                    "Platform IDs must be merged first, e.g. %(duplicates)s",
+                    duplicates=self.env.cr.fetchall(),
+                )) from e
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import time
+
+from odoo import api, models, tools
+from odoo.exceptions import AccessDenied
+
+
+class ResUsersApikeys(models.Model):
+    _inherit = "res.users.apikeys"
+
+    @api.model
+    def _caram_check_credentials(self, key):
+        """`_check_credentials(scope="api")` with a per-worker cache for the CarAm controllers.
+
+        Entries are keyed by the SHA-256 of the key (never the key itself) and a time bucket of
+        `caram.api.auth_cache_ttl` seconds (default 60, 0 disables the cache), so a verified
+        key is re-hashed at most once per bucket. Revoking a key clears the cache right away.
+        """
+        ttl = int(self.env["ir.config_parameter"].sudo().get_param("caram.api.auth_cache_ttl", 60))
+        if ttl <= 0:
+            return self._check_credentials(scope="api", key=key)
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        try:
+            return self._caram_cached_check_credentials(digest, int(time.time() // ttl), key)
+        except AccessDenied:
+            return None
+
+    @tools.ormcache("digest", "bucket")
+    def _caram_cached_check_credentials(self, digest, bucket, key):
+        # Failures raise so they are not cached: unknown tokens cannot fill the cache
+        user_id = self._check_credentials(scope="api", key=key)
+        if not user_id:
+            raise AccessDenied()
+        return user_id
+
+    def unlink(self):
+        res = super().unlink()
+        self.env.registry.clear_cache()
+        return res
@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields, api
+from dateutil.relativedelta import relativedelta
+
+import psycopg2
+
+from odoo import models, fields, api, _
 from odoo import Command
+from odoo.exceptions import UserError
+from odoo.tools import float_compare
+from odoo.tools.sql import index_exists
+import logging
+_logger = logging.getLogger(__name__)
 
 
 class SaleOrder(models.Model):
@@ -12,6 +21,36 @@ class SaleOrder(models.Model):
         help='External subscription reference from CarAm system'
     )
 
+    def init(self):
+        super().init()
+        # One subscription per CarAm subscription id and company
+        if not index_exists(self.env.cr, "sale_order_caram_subscription_company_uniq"):
+            try:
+                with self.env.cr.savepoint(flush=False):
+                    self.env.cr.execute(
+                        """
+                        CREATE UNIQUE INDEX sale_order_caram_subscription_company_uniq
+                            ON sale_order (caram_subscription_id, company_id)
+                         WHERE caram_subscription_id IS NOT NULL AND plan_id IS NOT NULL
+                        """
+                    )
+            except psycopg2.errors.UniqueViolation as e:
+                self.env.cr.execute(
+                    """
+                    SELECT caram_subscription_id, company_id, array_agg(id ORDER BY id)
+                      FROM sale_order
+                     WHERE caram_subscription_id IS NOT NULL AND plan_id IS NOT NULL
+                  GROUP BY caram_subscription_id, company_id
+                    HAVING COUNT(*) > 1
+                     LIMIT 10
+                    """
+                )
+                raise UserError(_(
+                    "Cannot create the unique index on subscriptions (CarAm subscription ID, company): "
+                    "duplicate subscriptions must be cleaned up first, e.g. %(duplicates)s",
+                    duplicates=self.env.cr.fetchall(),
+                )) from e
+
     @api.model
     def create_subscription_with_invoice(self, partner_id, caram_subscription_id, 
                                          subscription_type, price, start_date, 
@@ -30,18 +69,15 @@ class SaleOrder(models.Model):
 
         # 3. Get partner and wallet
         partner = self.env['res.partner'].browse(partner_id)
-        wallet = self.env['loyalty.card'].sudo().search([
-            ('partner_id', '=', partner_id)
-        ], limit=1)
+        wallet = partner.sudo().caram_wallet_card_id
         
         if not wallet:
             return {'error': 'Wallet not found for this partner', 'status_code': 404}
 
-        # 4. Check wallet balance
-        print(f"Wallet balance: {wallet.points}")
-        print(f"Price: {price}")
-        wallet_balance = wallet.points
-        print(f"Wallet balance: {wallet_balance}")
+        # 4. Check wallet balance (locked until the end of the transaction)
+        wallet._caram_lock()
+        wallet_balance = wallet.caram_get_available_balance()
+        _logger.debug("CarAm: wallet %s balance %s, subscription price %s", wallet.id, wallet_balance, price)
         if price > wallet_balance:
             return {'error': 'Insufficient balance to pay invoice', 'status_code': 402}
 
@@ -84,13 +120,9 @@ class SaleOrder(models.Model):
         # --- FIX END ---
         
         # Set journal if configured (for subscription invoices)
-        journal = self.env['account.journal'].sudo().search([
-            ('company_id', '=', company_id),
-            ('type', '=', 'sale'),
-            ('is_used_for_subscriptions', '=', True)
-        ], limit=1)
-        if journal:
-            invoice.sudo().write({'journal_id': journal.id})
+        journal_id = self.env['res.company'].sudo().browse(company_id)._caram_get_config()['subscription_journal_id']
+        if journal_id:
+            invoice.sudo().write({'journal_id': journal_id})
 
         invoice.sudo().action_post()
 
@@ -153,29 +185,11 @@ class SaleOrder(models.Model):
 
     def _pay_invoice_from_wallet(self, invoice, wallet, amount, subscription):
         """Pay invoice using wallet balance"""
-        # Find available payments
-        payments = self.env['account.payment'].sudo().search([
-            ('partner_id', '=', invoice.partner_id.id),
-            ('state', '=', 'posted'),
-            ('payment_type', '=', 'inbound'),
-            ('is_reconciled', '=', False),
-        ])
-
-        # Get invoice lines to reconcile
-        invoice_lines = invoice.line_ids.filtered(
-            lambda line: line.account_id.account_type == 'asset_receivable' and not line.reconciled
-        )
-        payment_lines = payments.mapped('move_id.line_ids').filtered(
-            lambda line: line.account_id.account_type == 'asset_receivable' and not line.reconciled
-        )
-
-        # Reconcile if possible
-        lines_to_reconcile = invoice_lines + payment_lines
-        if lines_to_reconcile:
-            try:
-                lines_to_reconcile.sudo().reconcile()
-            except Exception as e:
-                return {'error': f'Failed to reconcile payment: {str(e)}', 'status_code': 500}
+        wallet._caram_lock()
+        try:
+            self._caram_reconcile_from_wallet(invoice)
+        except Exception as e:
+            return {'error': f'Failed to reconcile payment: {str(e)}', 'status_code': 500}
 
         # Create loyalty history record
         self.env['loyalty.history'].sudo().create({
@@ -188,8 +202,131 @@ class SaleOrder(models.Model):
         })
 
         # Update wallet points
-        new_balance = wallet.points - amount
-        wallet.sudo().write({'points': new_balance})
+        wallet.sudo().write({'points': wallet.caram_get_available_balance()})
 
         return {'success': True}
 
+    @api.model
+    def _caram_reconcile_from_wallet(self, invoice):
+        """Reconcile the open receivable of `invoice` with the wallet credits needed to cover it."""
+        # Get invoice lines to reconcile
+        invoice_lines = invoice.line_ids.filtered(
+            lambda line: line.account_id.account_type == 'asset_receivable' and not line.reconciled
+        )
+
+        # Match only the wallet credits needed to cover the invoice, oldest first
+        payment_lines = self.env['account.move.line']
+        for invoice_line in invoice_lines:
+            payment_lines |= invoice_line._caram_get_wallet_credit_lines(invoice_line.amount_residual, exclude=payment_lines)
+
+        lines_to_reconcile = invoice_lines + payment_lines
+        if lines_to_reconcile:
+            lines_to_reconcile.sudo().reconcile()
+
+    @api.model
+    def _cron_caram_renew_subscriptions(self, batch_size=200):
+        """Renew the CarAm subscriptions whose next invoice is due.
+
+        Subscriptions are renewed per company in batches, committing after each batch; the
+        ones whose wallet cannot pay are left as they are and retried on the next run. The
+        selection follows `next_invoice_date`, so a period already invoiced by the standard
+        recurring invoicing cron is not billed again.
+        """
+        today = fields.Date.context_today(self)
+        total = 0
+        for company in self.env['res.company'].sudo().search([]):
+            processed_ids = []
+            while True:
+                orders = self.sudo().with_company(company).search([
+                    ('company_id', '=', company.id),
+                    ('caram_subscription_id', '!=', False),
+                    ('subscription_state', '=', '3_progress'),
+                    ('next_invoice_date', '<=', today),
+                    ('id', 'not in', processed_ids),
+                ], order='next_invoice_date, id', limit=batch_size)
+                if not orders:
+                    break
+                processed_ids += orders.ids
+                try:
+                    renewed = orders._caram_renew_subscriptions()
+                except Exception:
+                    self.env.cr.rollback()
+                    _logger.exception("CarAm: renewal of subscriptions %s failed", orders.ids)
+                    continue
+                self.env.cr.commit()
+                total += len(renewed)
+        _logger.info("CarAm: renewed %s subscription(s) due on %s", total, today)
+        return total
+
+    def _caram_renew_subscriptions(self):
+        """Renew these subscriptions of one company for one more plan period.
+
+        The renewal invoices are created in one batch by the subscription machinery, then
+        their amounts are checked against the wallet balances read in one query; the renewals
+        a wallet cannot pay are undone. The wallets are charged with a single loyalty.history
+        insert.
+
+        Returns: the renewed subscriptions
+        """
+        company = self.company_id.ensure_one()
+        wallets = self.partner_id.caram_wallet_card_id
+        wallets._caram_lock()
+        balances = wallets._caram_get_available_balances()
+
+        # Extend the subscriptions ending before the period to invoice
+        previous = {order: (order.end_date, order.next_invoice_date) for order in self}
+        for order in self:
+            if order.end_date and order.end_date <= order.next_invoice_date:
+                plan = order.plan_id
+                order.end_date += relativedelta(**{f'{plan.billing_period_unit}s': plan.billing_period_value})
+
+        invoices = self._create_invoices(grouped=True)
+        invoice_by_order = {invoice.invoice_line_ids.sale_line_ids.order_id[:1]: invoice for invoice in invoices}
+
+        renewed = self.browse()
+        rejected = self.env['account.move']
+        for order in self:
+            invoice = invoice_by_order.get(order)
+            wallet = order.partner_id.caram_wallet_card_id
+            if not invoice:
+                _logger.warning("CarAm: nothing to invoice to renew subscription %s", order.caram_subscription_id)
+            elif not wallet or float_compare(
+                invoice.amount_total, balances.get(wallet.id, 0.0), precision_rounding=invoice.currency_id.rounding
+            ) > 0:
+                _logger.info("CarAm: insufficient wallet balance to renew subscription %s", order.caram_subscription_id)
+                rejected |= invoice
+            else:
+                balances[wallet.id] -= invoice.amount_total
+                renewed |= order
+                continue
+            order.end_date, order.next_invoice_date = previous[order]
+        rejected.unlink()
+        if not renewed:
+            return renewed
+
+        invoices -= rejected
+        invoice_vals = {'invoice_date': fields.Date.context_today(self)}
+        journal_id = company._caram_get_config()['subscription_journal_id']
+        if journal_id:
+            invoice_vals['journal_id'] = journal_id
+        invoices.write(invoice_vals)
+        invoices.action_post()
+
+        history_vals_list = []
+        for order in renewed:
+            invoice = invoice_by_order[order]
+            self._caram_reconcile_from_wallet(invoice)
+            history_vals_list.append({
+                'card_id': order.partner_id.caram_wallet_card_id.id,
+                'description': 'wallet_withdraw_transaction_for_subscription',
+                'used': invoice.amount_total,
+                'order_model': 'sale.order',
+                'order_id': order.id,
+                'status': 'posted',
+            })
+        histories = self.env['loyalty.history'].sudo().create(history_vals_list)
+        for wallet in histories.card_id:
+            wallet.sudo().write({'points': wallet.caram_get_available_balance()})
+
+        _logger.info("CarAm: renewed %s subscription(s) for %s", len(renewed), company.name)
+        return renewed
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import os
+import threading
+from http.server import ThreadingHTTPServer
+
+from odoo.addons.account.tests.common import AccountTestInvoicingCommon
+from odoo.tests import tagged
+
+
+def _load_stub_server():
+    path = os.path.join(os.path.dirname(__file__), os.pardir, "tools", "caram_stub_server.py")
+    spec = importlib.util.spec_from_file_location("caram_stub_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@tagged("post_install", "-at_install")
+class TestCaramStatusSync(AccountTestInvoicingCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        stub = _load_stub_server()
+        handler = type("QuietCaramStubHandler", (stub.CaramStubHandler,), {
+            "rejected": frozenset({"TX-REJECTED"}),
+            "log_message": lambda self, format, *args: None,
+        })
+        cls.stub_server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        cls.stub_thread = threading.Thread(target=cls.stub_server.serve_forever, daemon=True)
+        cls.stub_thread.start()
+        cls.addClassCleanup(cls.stub_server.server_close)
+        cls.addClassCleanup(cls.stub_server.shutdown)
+
+        cls.env["ir.config_parameter"].sudo().set_param(
+            "caram.api.base.url", "http://127.0.0.1:%s" % cls.stub_server.server_address[1]
+        )
+        cls.payments = cls.env["account.payment"].create([
+            {
+                "payment_type": "inbound",
+                "partner_type": "customer",
+                "partner_id": cls.partner_a.id,
+                "amount": 100.0,
+                "journal_id": cls.company_data["default_journal_bank"].id,
+                "caram_transaction_id": transaction_id,
+            }
+            for transaction_id in ("TX-ACCEPTED", "TX-REJECTED")
+        ])
+
+    def test_bulk_delivery_maps_each_result(self):
+        results = self.payments._caram_deliver_status_bulk("confirm")
+        self.assertEqual(results, {
+            "TX-ACCEPTED": False,
+            "TX-REJECTED": "Transaction rejected",
+        })
+
+    def test_bulk_outbox_records_each_result(self):
+        self.env["ir.config_parameter"].sudo().set_param("caram.api.bulk_status", "True")
+        messages = self.env["caram.status.outbox"]._caram_enqueue(self.payments, "confirm")
+        messages._caram_deliver()
+
+        accepted = messages.filtered(lambda m: m.caram_transaction_id == "TX-ACCEPTED")
+        rejected = messages - accepted
+        self.assertRecordValues(accepted, [{"state": "sent", "attempts": 1, "last_error": False}])
+        self.assertRecordValues(rejected, [{"state": "pending", "attempts": 1, "last_error": "Transaction rejected"}])
+        self.assertRecordValues(self.payments, [
+            {"caram_transaction_id": "TX-ACCEPTED", "caram_status_synced": True},
+            {"caram_transaction_id": "TX-REJECTED", "caram_status_synced": False},
+        ])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the CarAm platform status API.
+
+Point `caram.api.base.url` at it to exercise the status outbox without the real platform:
+
+    python CarAm/tools/caram_stub_server.py --port 8765 --reject TX-42 --delay 0.05
+
+It answers:
+
+- POST /api/change-transaction-status       one payload -> 200, or 422 for rejected ids; JSON, or
+  multipart/form-data with the attachment as newline-separated Fernet tokens (decrypted with
+  --secret when given, its size is logged either way)
+- POST /api/change-transaction-status/bulk  {"transactions": [...]} ->
+  {"results": [{"transaction_id": ..., "success": bool, "error": ...}, ...]}
+
+Every received payload is printed on stdout, one JSON line per transaction.
+"""
+
+import argparse
+from email.parser import BytesParser
+from email.policy import HTTP
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class CaramStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real platform
+    rejected = frozenset()
+    delay = 0.0
+    token = None
+    fernet = None
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _result(self, payload):
+        print(json.dumps(payload), flush=True)
+        transaction_id = payload.get("transaction_id")
+        if not transaction_id or payload.get("status") not in ("confirm", "decline"):
+            return {"transaction_id": transaction_id, "success": False, "error": "Invalid payload"}
+        if transaction_id in self.rejected:
+            return {"transaction_id": transaction_id, "success": False, "error": "Transaction rejected"}
+        return {"transaction_id": transaction_id, "success": True}
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        data = bytearray()
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if not size:
+                self.rfile.readline()
+                return bytes(data)
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _parse_multipart(self, raw):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + raw
+        )
+        body = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            content = part.get_payload(decode=True)
+            if part.get_filename() is None:
+                body[name] = content.decode()
+                continue
+            tokens = content.split(b"\n")
+            if self.fernet:
+                content = b"".join(self.fernet.decrypt(token) for token in tokens if token)
+            body[name] = {"filename": part.get_filename(), "chunks": len([t for t in tokens if t]), "size": len(content)}
+        return body
+
+    def do_POST(self):
+        raw = self._read_body()
+        try:
+            if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+                body = self._parse_multipart(raw)
+            else:
+                body = json.loads(raw or b"{}")
+        except ValueError:
+            return self._reply(400, {"error": "Invalid body"})
+        if self.token and self.headers.get("Authorization") != f"Bearer {self.token}":
+            return self._reply(401, {"error": "Unauthorized"})
+        time.sleep(self.delay)
+
+        if self.path == "/api/change-transaction-status":
+            result = self._result(body)
+            return self._reply(200 if result["success"] else 422, result)
+        if self.path == "/api/change-transaction-status/bulk":
+            return self._reply(200, {"results": [self._result(p) for p in body.get("transactions") or []]})
+        return self._reply(404, {"error": "Not found"})
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s - %s\n" % (self.address_string(), format % args))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--token", help="Require this bearer token")
+    parser.add_argument("--reject", action="append", default=[], help="Transaction id to reject (repeatable)")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds to wait before each answer")
+    parser.add_argument("--secret", help="caram.shared_secret, to decrypt uploaded attachments")
+    args = parser.parse_args(argv)
+
+    CaramStubHandler.rejected = frozenset(args.reject)
+    CaramStubHandler.delay = args.delay
+    CaramStubHandler.token = args.token
+    if args.secret:
+        from cryptography.fernet import Fernet
+        CaramStubHandler.fernet = Fernet(args.secret.encode())
+    server = ThreadingHTTPServer((args.host, args.port), CaramStubHandler)
+    print(f"CarAm stub listening on http://{args.host}:{args.port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
 from . import loyalty_history_wizard
+from . import caram_wallet_balance_wizard
 
 
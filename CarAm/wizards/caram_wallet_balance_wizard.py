@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models, _
+
+
+class CaramWalletBalanceWizard(models.TransientModel):
+    _name = "caram.wallet.balance.wizard"
+    _description = "Wallet Balance As Of Date"
+
+    date = fields.Date(required=True, default=fields.Date.context_today)
+    card_ids = fields.Many2many("loyalty.card", string="Wallets", required=True)
+    line_ids = fields.One2many("caram.wallet.balance.wizard.line", "wizard_id", readonly=True)
+
+    def action_compute(self):
+        self.ensure_one()
+        balances = self.card_ids.caram_get_balances_at(self.date)
+        self.line_ids = [(5, 0, 0)] + [
+            (0, 0, {"card_id": card.id, "balance": balances.get(card.id, 0.0)})
+            for card in self.card_ids
+        ]
+        return {
+            "type": "ir.actions.act_window",
+            "name": _("Wallet Balance As Of Date"),
+            "res_model": self._name,
+            "view_mode": "form",
+            "res_id": self.id,
+            "target": "new",
+        }
+
+
+class CaramWalletBalanceWizardLine(models.TransientModel):
+    _name = "caram.wallet.balance.wizard.line"
+    _description = "Wallet Balance As Of Date Line"
+
+    wizard_id = fields.Many2one("caram.wallet.balance.wizard", required=True, ondelete="cascade")
+    card_id = fields.Many2one("loyalty.card", string="Wallet", readonly=True)
+    partner_id = fields.Many2one(related="card_id.partner_id", readonly=True)
+    balance = fields.Float(readonly=True)
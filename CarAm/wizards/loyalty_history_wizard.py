@@ -96,9 +96,9 @@ class CaramLoyaltyHistoryWizard(models.TransientModel):
             "order_model": order_model,
             "order_id": order_id,
         }
+        self.card_id._caram_lock()
         history = self.env["loyalty.history"].create(history_vals)
-        new_balance = self.card_id.caram_get_posted_balance()
-        self.card_id.write({"points": new_balance})
+        self.card_id.write({"points": self.card_id.caram_get_available_balance()})
 
         return {
             "type": "ir.actions.act_window",